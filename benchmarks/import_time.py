@@ -0,0 +1,87 @@
+# Checks the start up cost of scrobbler.py using 'python -X importtime'.
+# Fails if the total import time goes over budget or if modules that should only be
+# loaded when they're needed (HTTP stack, HTML parser, etc.) are imported anyway.
+#
+# Usage: py benchmarks/import_time.py [--runs N]
+import re
+import sys
+import shutil
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Budgets are in milliseconds for the cumulative import time of everything
+SCENARIOS = {
+	'help': {
+		'args': ['-h'],
+		'budget_ms': 150,
+		'forbidden': ['requests', 'bs4', 'pendulum', 'sqlite3', 'http.server', 'webbrowser', 'concurrent.futures']
+	},
+	'check': {
+		'args': ['check', '-f', 'tracklist.txt'],
+		'budget_ms': 300,
+		'forbidden': ['requests', 'bs4', 'sqlite3', 'http.server', 'webbrowser']
+	}
+}
+
+IMPORT_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+def run_scenario(workdir, args):
+	proc = subprocess.run([sys.executable, '-X', 'importtime', str(ROOT/'scrobbler.py')] + args,
+						  cwd=workdir, capture_output=True, text=True)
+	total_us = 0
+	modules = {}
+	for line in proc.stderr.splitlines():
+		match = IMPORT_RE.match(line)
+		if match is None:
+			continue
+		self_us, cumulative_us, indent, module = match.groups()
+		modules[module] = int(cumulative_us)
+		# Only top level imports are added up, the nested ones are already in their cumulative time
+		if len(indent) == 1:
+			total_us += int(cumulative_us)
+	return (proc, total_us/1000, modules)
+
+def main():
+	parser = ArgumentParser(description='Checks the import time of scrobbler.py against its budgets.')
+	parser.add_argument('--runs', type=int, default=5, help='Number of runs per scenario, the fastest is used. Default: 5')
+	args = parser.parse_args()
+
+	failed = False
+	with tempfile.TemporaryDirectory() as workdir:
+		shutil.copy(ROOT/'config-empty.toml', Path(workdir)/'config.toml')
+		with open(Path(workdir)/'tracklist.txt', 'w', encoding='utf-8') as f:
+			f.write('!DATE 00:00\nArtist - Track\n')
+
+		for name, scenario in SCENARIOS.items():
+			best_ms = None
+			modules = {}
+			for _ in range(args.runs):
+				proc, total_ms, modules = run_scenario(workdir, scenario['args'])
+				if proc.returncode != 0:
+					print(f'{name}: scrobbler.py exited with {proc.returncode}')
+					print(proc.stderr.splitlines()[-1] if proc.stderr else '')
+					sys.exit(1)
+				if best_ms is None or total_ms < best_ms:
+					best_ms = total_ms
+
+			top = sorted(modules.items(), key=lambda x: x[1], reverse=True)[:5]
+			print(f'{name}: {best_ms:.1f}ms (budget {scenario["budget_ms"]}ms)')
+			for module, cumulative_us in top:
+				print(f'\t{module}: {cumulative_us/1000:.1f}ms')
+
+			if best_ms > scenario['budget_ms']:
+				print(f'\tOver budget by {best_ms - scenario["budget_ms"]:.1f}ms')
+				failed = True
+			loaded = [x for x in scenario['forbidden'] if x in modules]
+			if len(loaded) > 0:
+				print(f"\tShould not be imported: {', '.join(loaded)}")
+				failed = True
+
+	sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+	main()
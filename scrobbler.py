@@ -1,50 +1,216 @@
 from argparse import ArgumentParser
+from pathlib import Path
+from time import time
+import atexit
+import sys
 
 from utils.reader import Reader
 from utils.lfm_api import LastFM
-from utils.funcs import set_defaults, get_default
-
-# Setting defaults in case the user removed any necessary ones from the config.toml file.
-set_defaults()
+from utils.funcs import set_defaults, get_defaults, get_configs
+from utils.rate_limit import RateLimiter
+from utils.merge import merge_scrobbles
+from utils.metrics import metrics
 
 parser = ArgumentParser(
 	prog='Personal Last.FM Scrobbler',
 	description='This program is meant to read a list of tracks from either a txt or csv\nfile and send them to Last.FM (known as \'scrobbling\').'
 )
 
-DEFAULT_FILENAME = get_default('FILENAME')
-DEFAULT_PROFILE = get_default('PROFILE')
-DEFAULT_INC = get_default('INCREMENT')
-DEFAULT_SEP = get_default('CSV_SEPARATOR')
+# The profiler is started before the arguments are parsed (if --profile was given), so loading the config
+# for the defaults below is included in the profile
+profiler = None
+if __name__ == '__main__' and '--profile' in sys.argv[1:]:
+	from utils.profiler import RunProfiler
+	profiler = RunProfiler()
+	profiler.start()
+	atexit.register(profiler.stop)
+
+# Read once, rather than parsing the config for every default
+DEFAULTS = get_defaults()
+DEFAULT_FILENAME = DEFAULTS['FILENAME']
+DEFAULT_PROFILE = DEFAULTS['PROFILE']
+DEFAULT_INC = DEFAULTS['INCREMENT']
+DEFAULT_SEP = DEFAULTS['CSV_SEPARATOR']
 
-parser.add_argument('action', choices=['check', 'login', 'scrobble', 'logout'], default=['check'])
-parser.add_argument('-f', '--filename', default=DEFAULT_FILENAME, help=f'Specifies the file to read the scrobbles from. Default: {DEFAULT_FILENAME}')
+parser.add_argument('action', choices=['check', 'login', 'scrobble', 'logout', 'serve', 'work'], default=['check'])
+parser.add_argument('-f', '--filename', nargs='+', default=[DEFAULT_FILENAME], help=f'Specifies the file(s) to read the scrobbles from. Default: {DEFAULT_FILENAME}')
 parser.add_argument('-u','--user', default=DEFAULT_PROFILE, help=f'Specifies the user session to be used from the config.toml file. Default: {DEFAULT_PROFILE}')
 parser.add_argument('-i', '--increment', default=DEFAULT_INC, help=f'Specifies the default amount of time between scrobbles in minutes. Default: {DEFAULT_INC}')
 parser.add_argument('-s', '--separator', default=DEFAULT_SEP, help=f'Specifies the separator to be used when parsing CSV files. Default: {DEFAULT_SEP}')
+parser.add_argument('--fast', action='store_true', help='For the check action, only validates the files and counts the scrobbles without building them. Lines that cannot be split are reported instead of prompted for.')
+parser.add_argument('--non-interactive', action='store_true', help='Lines that cannot be split into an artist and track cause an error instead of a prompt.')
+parser.add_argument('--review', action='store_true', help='Lines that cannot be split into an artist and track are all reviewed together after the file is parsed instead of stopping on each one.')
+parser.add_argument('--artists', default=None, help='Specifies a file of known artist names (one per line) used to split ambiguous lines.')
+parser.add_argument('--merge', choices=['keep', 'keep-first', 'drop', 'shift'], default=None, help='Merges the scrobbles from all of the files into time order before sending. Sets how overlapping scrobbles from different files are handled.')
+parser.add_argument('--merge-gap', type=int, default=30, help='Min number of seconds between scrobbles from different files before they overlap when merging. Default: 30')
+parser.add_argument('--no-dedup', action='store_true', help='Sends repeated scrobbles (same artist, track and timestamp) instead of skipping them.')
+parser.add_argument('--dedup-memory', type=float, default=64, help='Max memory (in MB) used to find repeated scrobbles before switching to a Bloom filter backed by a temporary file. Default: 64')
+parser.add_argument('--mb-index', default=None, help='Specifies a MusicBrainz index file (see utils/mb_index.py) used to fill in the MBID and duration of scrobbles.')
+parser.add_argument('--emit', default=None, help='Writes the parsed scrobbles to a columnar file (.parquet, .arrow or .feather). Needs pyarrow.')
+parser.add_argument('--emit-results', default=None, help='Writes the result of every scrobble sent to a columnar file (.parquet, .arrow or .feather). Needs pyarrow.')
+parser.add_argument('--users', default=None, help='Comma separated list of user profiles to scrobble to at the same time. Supercedes -u/--user.')
+parser.add_argument('--all-profiles', action='store_true', help='Scrobbles to every logged in user profile in the config.toml file at the same time.')
+parser.add_argument('--no-callback', action='store_true', help='Logs in by waiting for Last.FM to authorize the session instead of having it redirect back to a local listener. Useful when the browser is on another machine.')
+parser.add_argument('--auth-port', type=int, default=0, help='Specifies the local port for the login callback to listen on. Default: any free port')
+parser.add_argument('--port', type=int, default=8750, help='Specifies the local port for the serve action to listen on. Default: 8750')
+parser.add_argument('--linger', type=float, default=60, help='Max number of seconds the serve action waits to fill up a batch before sending it anyway. Default: 60')
+parser.add_argument('--spool', default='spool', help='Specifies the shared spool directory the work action takes tracklists from. Default: spool')
+parser.add_argument('--lease-ttl', type=float, default=120, help='Number of seconds a work action\'s claim on a tracklist or profile lasts without a heartbeat before another worker can take it over. Default: 120')
+parser.add_argument('--profile', action='store_true', help='Profiles the run and writes the results (pstats, flamegraph stacks, allocations and stage times) to the logs folder.')
+parser.add_argument('--metrics-port', type=int, default=None, help='Serves metrics in the Prometheus text format on the given local port while the program runs.')
+parser.add_argument('--metrics-json', default=None, help='Writes the collected metrics to the given JSON file when the program exits.')
 
 
-def get_tracks(args):
-	r = Reader(args.increment, args.separator)
-	tracks = r.read(args.filename)
+def get_tracks(args, count_only=False):
+	r = Reader(args.increment, args.separator, not args.non_interactive, args.artists, args.review, count_only)
+	tracks = {}
+	emit = None
+	mb_index = None
+	if args.emit is not None:
+		from utils.export import ColumnarWriter
+		emit = ColumnarWriter(args.emit)
+	if args.mb_index is not None:
+		from utils.mb_index import MBIndex
+		mb_index = MBIndex(args.mb_index)
+	try:
+		for filename in args.filename:
+			tracks[filename] = r.read(filename)
+			if mb_index is not None:
+				scrobbles = Reader.serialize_scrobbles(tracks[filename])
+				enriched = mb_index.enrich(scrobbles)
+				print(f'Found MusicBrainz info for {enriched} of {len(scrobbles)} scrobbles in {filename}.')
+			if emit is not None:
+				# Written out file by file as they're parsed
+				for batch_id, batch in enumerate(tracks[filename]):
+					for scrobble in batch.scrobbles:
+						emit.write(scrobble, batch_id, filename)
+	finally:
+		if emit is not None:
+			emit.close()
+		if mb_index is not None:
+			mb_index.close()
 	return tracks
 
 
-def check(args):
-	tracks = get_tracks(args)
-	Reader.print_summary(tracks)
+def get_dedup(args):
+	if args.no_dedup:
+		return None
+	from utils.dedup import DuplicateFilter
+	return DuplicateFilter(int(args.dedup_memory*1024**2))
+
+
+def get_results_writer(args, profile=None):
+	if args.emit_results is None:
+		return None
+	from utils.export import ColumnarWriter
+	fpath = Path(args.emit_results)
+	if profile is not None:
+		# Each profile gets its own file when scrobbling to several at once
+		fpath = fpath.with_name(f'{fpath.stem}_{profile}{fpath.suffix}')
+	return ColumnarWriter(fpath)
+
+
+def check(args, fast=False):
+	if fast and (args.emit is not None or args.mb_index is not None):
+		raise Exception('--fast does not build the scrobbles, so it cannot be used with --emit or --mb-index.')
+	start = time()
+	tracks = get_tracks(args, fast)
+	elapsed = time() - start
+	batches = [batch for batches in tracks.values() for batch in batches]
+	Reader.print_summary(batches)
+
+	num_scrobbles = sum(len(batch) for batch in batches)
+	size = sum(Path(filename).stat().st_size for filename in args.filename) / 1024**2
+	elapsed = max(elapsed, 1e-6)
+	print(f'Checked {num_scrobbles} scrobbles ({size:.2f} MB) in {elapsed:.2f}s: {num_scrobbles/elapsed:.0f} scrobbles/s, {size/elapsed:.2f} MB/s')
 	return tracks
 
 
-def login(user):
-	lfm = LastFM(login=False, user=user)
-	success, user = lfm.login()
+def get_sources(tracks):
+	# Scrobbles for each file are kept separate so the log can account for them
+	return {filename: Reader.serialize_scrobbles(batches) for filename, batches in tracks.items()}
+
+
+# Merges the sources into a time ordered list of (source, scrobble) pairs, returned with the overlapping
+# scrobbles that were dropped. This has to happen before future scrobbles are split off, since shifting
+# overlaps can move a scrobble into the future.
+def merge_sources(sources, merge, merge_gap):
+	dropped = []
+	pairs = list(merge_scrobbles(sources, merge, merge_gap, lambda source, scrobble: dropped.append((source, scrobble))))
+	if len(dropped) > 0:
+		print(f'Dropped {len(dropped)} overlapping scrobbles.')
+	return (pairs, dropped)
+
+
+# Every profile has its own queue, so a service never sends another profile's scrobbles
+def get_queue(profile):
+	from utils.scrobble_queue import ScrobbleQueue
+	return ScrobbleQueue(Path('scrobble_queue')/f'queue_{profile}.db')
+
+
+# Only one process owns a profile's schedule at a time. Others can add to it, but the owner is the one
+# that sends them, so the service waits to own it.
+def get_scheduler(profile, wait=False):
+	from utils.scheduler import ScrobbleScheduler
+	return ScrobbleScheduler(Path('scrobble_queue')/f'schedule_{profile}.jsonl', wait)
+
+
+# Takes the scrobbles with timestamps in the future out of the sources (a dict or merged pairs), since
+# Last.FM would change them to the current time. Returns the sources that can be sent now, along with
+# the future scrobbles by source so they can be scheduled.
+def split_future(sources):
+	now = time()
+	future = {}
+	if isinstance(sources, dict):
+		ready = {}
+		for source, scrobbles in sources.items():
+			ready[source] = [x for x in scrobbles if x.timestamp <= now]
+			if len(ready[source]) < len(scrobbles):
+				future[source] = [x for x in scrobbles if x.timestamp > now]
+		return (ready, future)
+
+	ready = []
+	for source, scrobble in sources:
+		if scrobble.timestamp > now:
+			future.setdefault(source, []).append(scrobble)
+		else:
+			ready.append((source, scrobble))
+	return (ready, future)
+
+
+# Schedules the future scrobbles for the profile and returns any scheduled ones that are now due
+def schedule_future(profile, future):
+	fpath = Path('scrobble_queue')/f'schedule_{profile}.jsonl'
+	if len(future) == 0 and not fpath.exists():
+		return (None, [])
+	scheduler = get_scheduler(profile)
+	for source, scrobbles in future.items():
+		scheduler.add(scrobbles, source)
+	num_future = sum(len(x) for x in future.values())
+	if num_future > 0:
+		print(f'{num_future} scrobbles for {profile} are in the future and were scheduled. They will be sent by the serve action, or the next scrobble, once their time has passed.')
+	if not scheduler.owner:
+		print(f'The schedule for {profile} is in use by a running serve action (or another scrobble), so it will send any scheduled scrobbles that are due.')
+	return (scheduler, scheduler.due())
+
+
+def login(user, callback=True, port=0, rate_limiter=None):
+	lfm = LastFM(login=False, user=user, rate_limiter=rate_limiter)
+	success, user = lfm.login(callback, port)
 	if success:
 		print(f'User {user} logged in.')
 	else:
 		print(f'Unable to log in user profile {user}.')
 
 
+def login_profiles(args):
+	# One after the other, since each needs the user to authorize it in the browser
+	rate_limiter = RateLimiter()
+	for profile in [user.strip() for user in args.users.split(',') if user.strip() != '']:
+		print(f'Logging in user profile {profile}.')
+		login(profile, not args.no_callback, args.auth_port, rate_limiter)
+
+
 def logout(user):
 	lfm = LastFM(login=False, user=user)
 	success, user = lfm.logout()
@@ -54,22 +220,230 @@ def logout(user):
 		print(f'No user to logout for profile {user}.')	
 
 
+# Adds the scheduled scrobbles that are now due to the sources. They're older than anything just read, so they go first.
+def with_due(sources, scheduler, due):
+	if len(due) == 0:
+		return sources
+	due_scrobbles = [scrobble for _, scrobble in scheduler.to_scrobbles(due)]
+	if isinstance(sources, dict):
+		return {'schedule': due_scrobbles, **sources}
+	return [('schedule', scrobble) for scrobble in due_scrobbles] + sources
+
+
+# Sends the sources (minus any future scrobbles, which are scheduled) along with any scheduled ones that are now due
+def send_sources(lfm, profile, sources, merge=None, merge_gap=30, **kwargs):
+	dropped = []
+	if merge is not None:
+		sources, dropped = merge_sources(sources, merge, merge_gap)
+	sources, future = split_future(sources)
+	scheduler, due = schedule_future(profile, future)
+	try:
+		lfm.scrobble_sources(with_due(sources, scheduler, due), dropped=dropped, **kwargs)
+		if scheduler is not None:
+			scheduler.confirm(due)
+	finally:
+		if scheduler is not None:
+			scheduler.close()
+
+
 def scrobble(args):
 	lfm = LastFM(user=args.user)
-	scrobbles = check(args)
+	tracks = check(args)
+	results = get_results_writer(args)
+	dedup = get_dedup(args)
+	try:
+		send_sources(lfm, args.user, get_sources(tracks), results=results, merge=args.merge, merge_gap=args.merge_gap, dedup=dedup)
+	finally:
+		if results is not None:
+			results.close()
+		if dedup is not None:
+			dedup.close()
+
+
+def get_profiles(args, configs):
+	if args.all_profiles:
+		# Any section with a saved session key is a user profile
+		return [name for name, section in configs.items()
+				if isinstance(section, dict) and section.get('SESSION_KEY', '') != '']
+	return [user.strip() for user in args.users.split(',') if user.strip() != '']
+
+
+def scrobble_profiles(args):
+	from concurrent.futures import ThreadPoolExecutor
+	# Config and tracklist are only loaded once and shared between all of the profiles
+	configs = get_configs()
+	profiles = get_profiles(args, configs)
+	if len(profiles) == 0:
+		print('No user profiles to scrobble to.')
+		return
+
+	sources = get_sources(check(args))
+	dropped = []
+	if args.merge is not None:
+		# Merged once up front, rather than in every thread, since shifting changes the scrobbles
+		sources, dropped = merge_sources(sources, args.merge, args.merge_gap)
+	sources, future = split_future(sources)
+
+	dedup = get_dedup(args)
+	duplicates = {}
+	if dedup is not None:
+		# Also done once up front, so there's only one filter in memory. Repeats are counted
+		# by source here, and the counts are written to each profile's log.
+		from utils.dedup import drop_duplicates
+		def on_duplicate(source, scrobble):
+			duplicates[source] = duplicates.get(source, 0) + 1
+			metrics.inc('duplicates_dropped_total')
+		if isinstance(sources, dict):
+			sources = [(source, scrobble) for source, scrobbles in sources.items() for scrobble in scrobbles]
+		with dedup:
+			sources = list(drop_duplicates(sources, dedup, on_duplicate))
+		if len(duplicates) > 0:
+			counts = ', '.join(f'{k}: {v}' for k, v in duplicates.items())
+			print(f'Skipped {sum(duplicates.values())} duplicate scrobbles ({counts}).')
+
+	# All of the profiles use the same API key, so they share its rate limit
+	rate_limiter = RateLimiter()
 
-	scrobbles = Reader.serialize_scrobbles(scrobbles)
-	lfm.scrobble(scrobbles)
+	def send(profile):
+		lfm = LastFM(login=False, user=profile, configs=configs, rate_limiter=rate_limiter)
+		if not lfm.is_logged_in:
+			print(f'No saved user session for profile {profile}. Use the login action first.')
+			return
+		scheduler, due = schedule_future(profile, future)
+		# Progress bars from several threads would just garble each other
+		results = get_results_writer(args, profile)
+		try:
+			lfm.scrobble_sources(with_due(sources, scheduler, due), log_name=f'scrob_{profile}', progress=False, results=results, dropped=dropped, duplicates=duplicates)
+			if scheduler is not None:
+				scheduler.confirm(due)
+		finally:
+			if results is not None:
+				results.close()
+			if scheduler is not None:
+				scheduler.close()
+
+	with ThreadPoolExecutor(max_workers=len(profiles)) as executor:
+		for _ in executor.map(send, profiles):
+			pass
+
+
+# Takes tracklists from a spool directory shared with workers on other hosts and sends them,
+# one profile at a time. Runs until there's nothing left that this worker can claim.
+def work(args):
+	from utils.spool import Spool
+	configs = get_configs()
+	rate_limiter = RateLimiter()
+	with Spool(args.spool, args.lease_ttl, extensions=Reader.implemented_ext + Reader.compressed_ext) as spool:
+		print(f'Worker {spool.worker} using spool {spool.root.resolve()}')
+		while True:
+			reclaimed = spool.reclaim()
+			if reclaimed > 0:
+				print(f'Put {reclaimed} tracklist(s) from stopped workers back in the spool.')
+
+			profiles = spool.profiles()
+			if args.users is not None or args.all_profiles:
+				profiles = [x for x in profiles if x in get_profiles(args, configs)]
+
+			sent = 0
+			for profile in profiles:
+				if len(spool.pending(profile)) == 0:
+					continue
+				profile_lease = spool.acquire_profile(profile)
+				if profile_lease is None:
+					print(f'Profile {profile} is being sent by another worker, skipping it.')
+					continue
+				# Repeats are found across all of the profile's tracklists in this run
+				dedup = get_dedup(args)
+				try:
+					lfm = LastFM(login=False, user=profile, configs=configs, rate_limiter=rate_limiter)
+					if not lfm.is_logged_in:
+						print(f'No saved user session for profile {profile}. Use the login action first.')
+						continue
+					for fpath in spool.pending(profile):
+						if not profile_lease.held:
+							print(f'Lost the lease on profile {profile}, leaving the rest of its tracklists to another worker.')
+							break
+						claim = spool.claim(fpath)
+						if claim is None:
+							continue
+						fpath, lease = claim
+						try:
+							# Nobody is around to answer prompts
+							r = Reader(args.increment, args.separator, interactive=False)
+							send_sources(lfm, profile, get_sources({fpath.name: r.read(fpath)}), log_name=f'work_{profile}_{fpath.name}', progress=False, dedup=dedup)
+						except Exception as e:
+							print(f'Unable to send {fpath.name} to {profile}: {e}')
+							if spool.fail(fpath, lease, e) is None:
+								print(f'Lost the claim on {fpath.name} while sending it, it was left to the worker that took it over.')
+						else:
+							if spool.complete(fpath, lease) is None:
+								print(f'Lost the claim on {fpath.name} while sending it, it was left to the worker that took it over.')
+							sent += 1
+				finally:
+					spool.release_profile(profile_lease)
+					if dedup is not None:
+						dedup.close()
+
+			# More may have been added while sending
+			if sent == 0:
+				break
+
+
+def serve(args):
+	from utils.service import ScrobbleService
+	from utils.file_lock import FileLock
+	lfm = LastFM(user=args.user)
+	if not lfm.is_logged_in:
+		print(f'Unable to start the service without a logged in user for profile {args.user}.')
+		return
+	# Only one service can send from a profile's queue at a time, otherwise both would send the same scrobbles
+	queue_lock = FileLock(Path('scrobble_queue')/f'queue_{args.user}.lock')
+	if not queue_lock.acquire(blocking=False):
+		print(f'A serve action is already running for profile {args.user}.')
+		return
+	try:
+		service = ScrobbleService(lfm, args.increment, args.separator, queue=get_queue(args.user),
+								  linger=args.linger, scheduler=get_scheduler(args.user, wait=True))
+		service.start(args.port)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		queue_lock.release()
 
 
 if __name__ == '__main__':
 	args = parser.parse_args()
+
+	# Setting defaults in case the user removed any necessary ones from the config.toml file.
+	# Done after parsing the arguments so that -h doesn't have to touch the file.
+	set_defaults()
+
+	if args.metrics_port is not None:
+		metrics.serve(args.metrics_port)
+	if args.metrics_json is not None:
+		atexit.register(metrics.dump_json, args.metrics_json)
+	if args.profile and profiler is None:
+		# Given as an abbreviation, e.g. --prof
+		from utils.profiler import RunProfiler
+		profiler = RunProfiler()
+		profiler.start()
+		atexit.register(profiler.stop)
 	
 	if args.action == 'check':
-		_ = check(args)
+		_ = check(args, args.fast)
 	elif args.action == 'login':
-		login(args.user)
+		if args.users is not None:
+			login_profiles(args)
+		else:
+			login(args.user, not args.no_callback, args.auth_port)
 	elif args.action == 'logout':
 		logout(args.user)
 	elif args.action == 'scrobble':
-		scrobble(args)
\ No newline at end of file
+		if args.users is not None or args.all_profiles:
+			scrobble_profiles(args)
+		else:
+			scrobble(args)
+	elif args.action == 'serve':
+		serve(args)
+	elif args.action == 'work':
+		work(args)
\ No newline at end of file
@@ -0,0 +1,33 @@
+import random
+
+from utils.scheduler import TimingWheel
+
+# Checks the wheel against a plain sorted list, with items anywhere from already due to past the overflow
+def test_timing_wheel_matches_sorted_list():
+	rng = random.Random(1234)
+	for _ in range(500):
+		start = rng.randrange(0, 1 << 30)
+		wheel = TimingWheel(start)
+		now = start
+		expected = []
+		for step in range(rng.randrange(1, 60)):
+			if rng.random() < 0.6:
+				ts = now + rng.choice([-10, 0, rng.randrange(256), rng.randrange(1024), rng.randrange(1 << 16), rng.randrange(1 << 24), rng.randrange(1 << 26)])
+				wheel.insert(ts, step)
+				expected.append((max(ts, now), step))
+			else:
+				now += rng.choice([1, rng.randrange(256), rng.randrange(1024), rng.randrange(1 << 16), rng.randrange(1 << 24)])
+				due = wheel.advance(now)
+				assert sorted(due) == sorted(step for ts, step in expected if ts <= now)
+				expected = [x for x in expected if x[0] > now]
+
+			expected.sort()
+			assert len(wheel) == len(expected)
+			assert wheel.next_due() == (expected[0][0] if len(expected) > 0 else None)
+
+def test_next_due_after_advance():
+	wheel = TimingWheel(0)
+	wheel.insert(300, 'a')
+	wheel.advance(200)
+	wheel.insert(450, 'b')
+	assert wheel.next_due() == 300
@@ -0,0 +1,129 @@
+import re
+from pathlib import Path
+
+# Separator between artist and track, allowing for a missing space on one side of the dash
+# (e.g. "Geck-o -It's What We Are"). A dash with no spaces at all is part of a name.
+SEPARATOR_RE = re.compile(r'\s+[-–—]\s*|[-–—]\s+')
+DASHES = [' - ', ' – ', ' — ']
+
+# Marks the end of a name in the trie
+_END = '\0'
+
+class ArtistIndex:
+	def __init__(self):
+		self.__root = {}
+		self.__size = 0
+
+	def __len__(self):
+		return self.__size
+
+	def __contains__(self, name):
+		node = self.__root
+		for c in name.casefold():
+			node = node.get(c)
+			if node is None:
+				return False
+		return _END in node
+
+	def add(self, name):
+		name = ' '.join(name.split())
+		if name == '':
+			return
+		node = self.__root
+		for c in name.casefold():
+			node = node.setdefault(c, {})
+		if _END not in node:
+			node[_END] = True
+			self.__size += 1
+
+	# Every index in the text at which a known artist name ends, in a single pass over the text
+	def prefix_ends(self, text):
+		ends = []
+		node = self.__root
+		for i, c in enumerate(text):
+			# casefold can turn one character into several (e.g. ß -> ss)
+			for k in c.casefold():
+				node = node.get(k)
+				if node is None:
+					return ends
+			if _END in node:
+				ends.append(i+1)
+		return ends
+
+	# Attempts to pick the split for a line without asking the user.
+	# Returns the (line, splits) to use or None if the index can't decide.
+	def resolve(self, line, splits):
+		ends = self.prefix_ends(line)
+		if len(ends) == 0:
+			return None
+
+		if len(splits) > 1:
+			# Only the splits which start right after a known artist are candidates
+			candidates = [split for split in splits if split[0] in ends]
+			if len(candidates) == 1:
+				return (line, candidates)
+			return None
+
+		if len(splits) == 0:
+			# No proper separator, look for a known artist followed by a dash with missing spaces.
+			# Longest artist is checked first, so 'DJ Phil Ty' wins over 'DJ Phil'.
+			for end in reversed(ends):
+				sep = SEPARATOR_RE.match(line, end)
+				if sep is not None:
+					track = line[sep.end():]
+					if track != '':
+						new_line = f'{line[:end]} - {track}'
+						return (new_line, [(end, end+3)])
+			return None
+
+		return None
+
+	@staticmethod
+	def __single_split(text):
+		# Only lines with exactly one separator can be trusted to give the right artist
+		found = [d for d in DASHES if d in text]
+		if len(found) != 1 or text.count(found[0]) != 1:
+			return None
+		return text.split(found[0], 1)[0]
+
+	def add_from_tracklist(self, fpath):
+		with open(fpath, 'r', encoding='utf-8') as f:
+			for line in f:
+				line = ' '.join(line.split())
+				if line == '' or line.startswith('!'):
+					continue
+				artist = self.__single_split(line)
+				if artist is not None:
+					self.add(artist)
+
+	def add_from_log(self, fpath):
+		log_re = re.compile(r'^(?:Accepted|Ignored): (.*) \(\d+\)$')
+		with open(fpath, 'r', encoding='UTF-8') as f:
+			for line in f:
+				match = log_re.match(line.rstrip('\n'))
+				if match is None:
+					continue
+				artist = self.__single_split(match.group(1))
+				if artist is not None:
+					self.add(artist)
+
+	def add_from_seed(self, fpath):
+		# One artist name per line
+		with open(fpath, 'r', encoding='utf-8') as f:
+			for line in f:
+				self.add(line)
+
+	@staticmethod
+	def build(log_folder='logs', cache_folder='liveset_cache', seed_file=None):
+		index = ArtistIndex()
+		log_folder = Path(log_folder)
+		if log_folder.exists():
+			for fpath in log_folder.glob('*.log'):
+				index.add_from_log(fpath)
+		cache_folder = Path(cache_folder)
+		if cache_folder.exists():
+			for fpath in cache_folder.glob('*.txt'):
+				index.add_from_tracklist(fpath)
+		if seed_file is not None:
+			index.add_from_seed(seed_file)
+		return index
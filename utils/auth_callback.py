@@ -0,0 +1,67 @@
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+PAGE = (
+	'<html><body style="font-family: sans-serif">'
+	'<h3>Logged in to Last.FM.</h3><p>You can close this tab and go back to the scrobbler.</p>'
+	'</body></html>'
+)
+
+# Short lived listener on localhost used as the callback for Last.FM's web authorization.
+# Once the user allows access, Last.FM redirects the browser to the callback with the token,
+# so it can be exchanged for a session right away instead of polling until it's authorized.
+class AuthCallback:
+	def __init__(self, port=0, host='127.0.0.1'):
+		self.token = None
+		self.__received = threading.Event()
+		callback = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				token = parse_qs(urlparse(self.path).query).get('token', [None])[0]
+				if token is None:
+					# Browsers also ask for things like the favicon
+					self.send_response(404)
+					self.end_headers()
+					return
+				body = PAGE.encode()
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/html; charset=utf-8')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+				callback.receive(token)
+
+			def log_message(self, format, *args):
+				pass
+
+		# Port 0 picks any free port
+		self.__server = HTTPServer((host, int(port)), Handler)
+		self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+		self.__thread.start()
+
+	@property
+	def url(self):
+		host, port = self.__server.server_address[:2]
+		return f'http://{host}:{port}/'
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def receive(self, token):
+		self.token = token
+		self.__received.set()
+
+	# Waits for the redirect and returns its token, or None if it didn't come in time
+	def wait(self, timeout=None):
+		self.__received.wait(timeout)
+		return self.token
+
+	def close(self):
+		self.__server.shutdown()
+		self.__server.server_close()
+		self.__thread.join()
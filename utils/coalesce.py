@@ -0,0 +1,37 @@
+# Merges scrobbles coming from several sources (files, tracklist batches, etc.)
+# into full API batches so that a partially filled request is only sent at the end.
+# Every item in a batch keeps the name of the source it came from for accounting.
+# The serve action waits for partial batches in its persistent queue instead (see utils/service.py.)
+class BatchCoalescer:
+	def __init__(self, on_batch, batch_size=50):
+		# on_batch(batch, sources) is called with the scrobbles and their matching source names
+		self.on_batch = on_batch
+		# Max amount allowed at a time by the LastFM API
+		self.batch_size = min(batch_size, 50)
+
+		self.__pending = []
+		self.__sources = []
+
+	def __len__(self):
+		return len(self.__pending)
+
+	def add(self, scrobbles, source=''):
+		for scrobble in scrobbles:
+			self.__pending.append(scrobble)
+			self.__sources.append(source)
+			if len(self.__pending) >= self.batch_size:
+				self.__emit()
+
+	def flush(self):
+		if len(self.__pending) > 0:
+			self.__emit()
+
+	def close(self):
+		self.flush()
+
+	def __emit(self):
+		batch = self.__pending[:self.batch_size]
+		sources = self.__sources[:self.batch_size]
+		self.__pending = self.__pending[self.batch_size:]
+		self.__sources = self.__sources[self.batch_size:]
+		self.on_batch(batch, sources)
@@ -0,0 +1,132 @@
+import tempfile
+from hashlib import blake2b
+from pathlib import Path
+
+# Drops repeated scrobbles (same artist, track and timestamp) before they're sent.
+#
+# Keys are kept in a set until it would go over max_memory (in bytes). After that the filter
+# switches to a Bloom filter of max_memory bytes, backed by a temporary sqlite table of every
+# key seen. The table is only checked when the Bloom filter says a key might have been seen,
+# so false positives never drop a scrobble and most lookups never touch the disk.
+class DuplicateFilter:
+	# Rough size of a key in the set, including the set's own overhead
+	ENTRY_BYTES = 160
+	NUM_HASHES = 7
+	# Keys waiting to be written to the table are flushed in chunks this size
+	FLUSH_SIZE = 10000
+
+	def __init__(self, max_memory=64*1024**2):
+		self.max_memory = max_memory
+		self.exact_limit = max(1, max_memory // self.ENTRY_BYTES)
+		self.seen = 0
+		self.dropped = 0
+
+		self.__keys = set()
+		self.__bloom = None
+		self.__num_bits = 0
+		self.__db = None
+		self.__temp_dir = None
+		self.__pending = set()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	@property
+	def mode(self):
+		return 'exact' if self.__bloom is None else 'bloom'
+
+	@staticmethod
+	def __key(scrobble):
+		return (scrobble.artist, scrobble.text, int(scrobble.timestamp))
+
+	# Returns True the first time the scrobble is seen, False for any repeats
+	def add(self, scrobble):
+		key = self.__key(scrobble)
+		if self.__bloom is None:
+			if key in self.__keys:
+				self.dropped += 1
+				return False
+			self.__keys.add(key)
+			self.seen += 1
+			if len(self.__keys) > self.exact_limit:
+				self.__switch()
+			return True
+
+		digest = self.__digest(key)
+		if self.__test_and_set(digest) and self.__exists(digest):
+			self.dropped += 1
+			return False
+		self.__pending.add(digest)
+		if len(self.__pending) >= self.FLUSH_SIZE:
+			self.__flush()
+		self.seen += 1
+		return True
+
+	@staticmethod
+	def __digest(key):
+		artist, track, ts = key
+		return blake2b(f'{artist}\t{track}\t{ts}'.encode(), digest_size=16).digest()
+
+	# Sets the key's bits, returning whether they were all set already
+	def __test_and_set(self, digest):
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+		present = True
+		for i in range(self.NUM_HASHES):
+			bit = (h1 + i*h2) % self.__num_bits
+			byte, mask = bit >> 3, 1 << (bit & 7)
+			if not self.__bloom[byte] & mask:
+				present = False
+				self.__bloom[byte] |= mask
+		return present
+
+	def __exists(self, digest):
+		if digest in self.__pending:
+			return True
+		return self.__db.execute('SELECT 1 FROM seen WHERE key = ?', (digest,)).fetchone() is not None
+
+	def __flush(self):
+		with self.__db:
+			self.__db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', ((x,) for x in self.__pending))
+		self.__pending = set()
+
+	def __switch(self):
+		import sqlite3
+		self.__temp_dir = tempfile.TemporaryDirectory()
+		self.__db = sqlite3.connect(Path(self.__temp_dir.name)/'seen.db')
+		self.__db.execute('PRAGMA journal_mode = OFF')
+		self.__db.execute('PRAGMA synchronous = OFF')
+		self.__db.execute('CREATE TABLE seen (key BLOB PRIMARY KEY) WITHOUT ROWID')
+
+		self.__bloom = bytearray(self.max_memory)
+		self.__num_bits = len(self.__bloom) * 8
+		keys = self.__keys
+		self.__keys = set()
+		for key in keys:
+			digest = self.__digest(key)
+			self.__test_and_set(digest)
+			self.__pending.add(digest)
+			if len(self.__pending) >= self.FLUSH_SIZE:
+				self.__flush()
+		self.__flush()
+
+	def close(self):
+		if self.__db is not None:
+			self.__db.close()
+			self.__db = None
+			self.__temp_dir.cleanup()
+		self.__bloom = None
+		self.__keys = set()
+		self.__pending = set()
+
+
+# Yields the (source, scrobble) pairs which haven't been seen before, calling on_drop with any repeats
+def drop_duplicates(pairs, dup_filter, on_drop=None):
+	for source, scrobble in pairs:
+		if dup_filter.add(scrobble):
+			yield (source, scrobble)
+		elif on_drop is not None:
+			on_drop(source, scrobble)
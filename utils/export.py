@@ -0,0 +1,101 @@
+from pathlib import Path
+
+# Writes scrobbles (and the results of sending them) to columnar files for analysis.
+# The format is picked from the suffix: .parquet for Parquet, .arrow/.feather for Arrow IPC.
+# Rows are buffered and written out in record batches so large runs don't build the whole table in memory.
+class ColumnarWriter:
+	COLUMNS = ['timestamp', 'artist', 'track', 'album', 'album_artist', 'track_no', 'batch_id', 'source', 'status', 'ignore_code']
+	implemented_ext = ['.parquet', '.arrow', '.feather']
+
+	def __init__(self, fname, rows_per_batch=10000):
+		self.fpath = Path(fname)
+		if self.fpath.suffix.lower() not in self.implemented_ext:
+			raise Exception(f'Export not yet implemented for {self.fpath.suffix} files.')
+
+		try:
+			import pyarrow
+		except ImportError:
+			raise Exception('pyarrow is needed to export scrobbles. It can be installed with: pip install pyarrow')
+		self.__pa = pyarrow
+		self.schema = pyarrow.schema([
+			('timestamp', pyarrow.int64()),
+			('artist', pyarrow.string()),
+			('track', pyarrow.string()),
+			('album', pyarrow.string()),
+			('album_artist', pyarrow.string()),
+			('track_no', pyarrow.int32()),
+			('batch_id', pyarrow.int32()),
+			('source', pyarrow.string()),
+			('status', pyarrow.string()),
+			('ignore_code', pyarrow.int32())
+		])
+		self.rows_per_batch = rows_per_batch
+		self.__rows = {col: [] for col in self.COLUMNS}
+		self.__num_rows = 0
+		self.__writer = None
+		self.__closed = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	@staticmethod
+	def __to_int(val):
+		# Track numbers from CSV files are strings, and -1 means it wasn't set
+		try:
+			val = int(val)
+		except (TypeError, ValueError):
+			return None
+		return val if val != -1 else None
+
+	def write(self, scrobble, batch_id=None, source=None, status=None, ignore_code=None):
+		record = scrobble.to_record()
+		row = {
+			'timestamp': int(record['timestamp']),
+			'artist': record['artist'],
+			'track': record['track'],
+			'album': record['album'],
+			'album_artist': record['album_artist'],
+			'track_no': self.__to_int(record['track_no']),
+			'batch_id': batch_id,
+			'source': source,
+			'status': status,
+			'ignore_code': self.__to_int(ignore_code)
+		}
+		for col in self.COLUMNS:
+			self.__rows[col].append(row[col])
+		self.__num_rows += 1
+		if self.__num_rows >= self.rows_per_batch:
+			self.flush()
+
+	def flush(self):
+		if self.__num_rows == 0:
+			return
+		pa = self.__pa
+		batch = pa.record_batch([pa.array(self.__rows[col], type=self.schema.field(col).type) for col in self.COLUMNS],
+								schema=self.schema)
+		if self.__writer is None:
+			self.__writer = self.__open_writer()
+		self.__writer.write_batch(batch)
+		self.__rows = {col: [] for col in self.COLUMNS}
+		self.__num_rows = 0
+
+	def __open_writer(self):
+		if self.fpath.suffix.lower() == '.parquet':
+			import pyarrow.parquet as pq
+			return pq.ParquetWriter(self.fpath, self.schema)
+		else:
+			import pyarrow.ipc as ipc
+			return ipc.new_file(self.fpath, self.schema)
+
+	def close(self):
+		if self.__closed:
+			return
+		self.__closed = True
+		self.flush()
+		if self.__writer is None:
+			# Nothing was written, but there should still be an (empty) file
+			self.__writer = self.__open_writer()
+		self.__writer.close()
@@ -0,0 +1,58 @@
+import os
+from pathlib import Path
+
+# Exclusive lock on a file, held by this process until it's released or the process exits.
+# The OS drops the lock if the process dies, so it's never left behind like a lock file would be.
+# Only locks against other holders of the same lock file, it doesn't stop anything from reading or writing the files it guards.
+class FileLock:
+	def __init__(self, path):
+		self.path = Path(path)
+		self.__file = None
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, *exc):
+		self.release()
+
+	@property
+	def held(self):
+		return self.__file is not None
+
+	# Returns False if someone else holds it and blocking is off, otherwise waits for it
+	def acquire(self, blocking=True):
+		if self.__file is not None:
+			return True
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		f = open(self.path, 'a+')
+		try:
+			if os.name == 'nt':
+				import msvcrt
+				f.seek(0)
+				# LK_LOCK gives up after about 10 seconds, so it's retried until it's free
+				while True:
+					try:
+						msvcrt.locking(f.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+						break
+					except OSError:
+						if not blocking:
+							raise
+			else:
+				import fcntl
+				fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except OSError:
+			f.close()
+			return False
+		self.__file = f
+		return True
+
+	def release(self):
+		if self.__file is None:
+			return
+		if os.name == 'nt':
+			import msvcrt
+			self.__file.seek(0)
+			msvcrt.locking(self.__file.fileno(), msvcrt.LK_UNLCK, 1)
+		self.__file.close()
+		self.__file = None
@@ -1,24 +1,18 @@
-from time import time
 import sys
 from tomlkit import parse, dumps
 from pathlib import Path
 from enum import Enum
 
-def progressbar_batch(it, batch_size=50, prefix="", size=60, out=sys.stdout):
-	count = len(it)
-	start = time()
-	def show(j):
-		x = int(size*j/count)
-        # time estimate calculation and string
-		remaining = ((time() - start) / j) * (count - j)        
-		mins, sec = divmod(remaining, 60) # limited to minutes
-		time_str = f'{int(mins):02d}:{sec:04.1f}'
-		print(f"{prefix}[{u'█'*x}{('.'*(size-x))}] {j}/{count} Est wait {time_str}    ", end='\r', file=out, flush=True)
-	for batch, i in loop_batch(it, batch_size, True):
-		yield batch
-		show(i+1)
-		batch = []
-	print("", flush=True, file=out)
+from utils.progress import Progress
+from utils.metrics import metrics
+
+def progressbar_batch(it, batch_size=50, prefix="", size=60, out=sys.stdout, schedule=None, enabled=None):
+	# Generators don't have a length, the progress bar just counts up in that case
+	count = len(it) if hasattr(it, '__len__') else None
+	with Progress(count, prefix, size, out, schedule=schedule, enabled=enabled) as progress:
+		for batch in loop_batch(it, batch_size):
+			yield batch
+			progress.update(len(batch))
 
 def progressbar(it, prefix="", size=60, out=sys.stdout):
 	for x in progressbar_batch(it, 1, prefix, size, out):
@@ -26,23 +20,31 @@ def progressbar(it, prefix="", size=60, out=sys.stdout):
 
 def loop_batch(it, batch_size=50, return_index=False):
 	batch = []
+	i = -1
 	for i, item in enumerate(it):
 		batch.append(item)
-		if (i+1)%batch_size > 0 and (i+1) != len(it):
+		if len(batch) < batch_size:
 			continue
 		if return_index:
 			yield (batch, i)
 		else:
 			yield batch
 		batch = []
+	# Whatever is left over once the iterable runs out
+	if len(batch) > 0:
+		if return_index:
+			yield (batch, i)
+		else:
+			yield batch
 
 def get_configs(section=None, key=None, config_file='config.toml'):
 	config_path = Path(config_file)
 	if not config_path.exists():
 		raise Exception(f'Unable to find config file at {config_path.resolve()}')
 	
-	with open(config_file, 'r') as f:
-		configs = parse(f.read())
+	with metrics.stage('config_load'):
+		with open(config_file, 'r') as f:
+			configs = parse(f.read())
 
 	if section is not None:
 		configs = configs.get(section, {})
@@ -59,15 +61,19 @@ def set_configs(section=None, key=None, val=None, config_file='config.toml', ove
 	with open(config_file, 'r') as f:
 		configs = parse(f.read())
 
+	changed = False
 	if section is not None:
 		if section not in configs:
 			configs[section] = {}
 		if (key in configs[section] and overwrite) \
 			or key not in configs[section]:
 			configs[section].update({key: val})
+			changed = True
 	
-	with open(config_file, 'w') as f:
-		f.write(dumps(configs))
+	# No need to rewrite the file if nothing was changed
+	if changed:
+		with open(config_file, 'w') as f:
+			f.write(dumps(configs))
 
 class __DEFAULTS(Enum):
 	FILENAME		= 'tracklist.txt'
@@ -75,16 +81,36 @@ class __DEFAULTS(Enum):
 	INCREMENT		= 3
 	CSV_SEPARATOR	= ','
 
-def set_defaults():
-	for default_config in list(__DEFAULTS):
-		set_configs('DEFAULTS', default_config.name, default_config.value, overwrite=False)
+def set_defaults(config_file='config.toml'):
+	configs = get_configs(config_file=config_file)
+	defaults = configs.get('DEFAULTS', {})
+	missing = [x for x in list(__DEFAULTS) if x.name not in defaults]
+	if len(missing) == 0:
+		# Nothing to add, so the file is left alone
+		return
+
+	if 'DEFAULTS' not in configs:
+		configs['DEFAULTS'] = {}
+	for default_config in missing:
+		configs['DEFAULTS'][default_config.name] = default_config.value
+	with open(config_file, 'w') as f:
+		f.write(dumps(configs))
 
-def get_default(setting):
-	default = get_configs('DEFAULTS', setting)
+# An already parsed config can be passed in to avoid reading the file again
+def get_default(setting, configs=None):
+	if configs is None:
+		default = get_configs('DEFAULTS', setting)
+	else:
+		default = configs.get('DEFAULTS', {}).get(setting)
 	if default is None:
 		default = __DEFAULTS[setting].value
 	return default
 
+def get_defaults(configs=None):
+	if configs is None:
+		configs = get_configs()
+	return {x.name: get_default(x.name, configs) for x in list(__DEFAULTS)}
+
 def get_path_obj(fname):
 	if isinstance(fname, Path):
 		pass
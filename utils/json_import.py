@@ -0,0 +1,137 @@
+import json
+from datetime import datetime, timezone
+
+# Streaming readers and field mappings for listening history exports.
+#
+# Supported entries:
+#	Spotify extended streaming history:	ts, ms_played, master_metadata_track_name, master_metadata_album_artist_name, ...
+#	Spotify account data history:		endTime, artistName, trackName, msPlayed
+#	Last.FM (recent tracks) JSON backups:	name, artist{#text, mbid}, album{#text, mbid}, mbid, date{uts}
+#										(or pages of these under a 'track' key)
+#	Scrobble records:					artist, track, timestamp, album, album_artist, track_no, mbid, duration
+
+# Last.FM won't count anything played for less than 30 seconds
+MIN_PLAYED_MS = 30*1000
+
+# Yields each element of a top level JSON array without loading the whole file.
+# Anything other than an array is decoded in one go and yielded as a single item.
+def iter_json_array(file, chunk_size=1<<16):
+	decoder = json.JSONDecoder()
+	buf = file.read(chunk_size)
+	eof = len(buf) < chunk_size
+	idx = 0
+
+	def skip(chars):
+		nonlocal idx
+		while idx < len(buf) and buf[idx] in chars:
+			idx += 1
+
+	skip(' \t\r\n﻿')
+	if idx < len(buf) and buf[idx] != '[':
+		# Not an array, so it can't be streamed
+		yield json.loads(buf[idx:] + file.read())
+		return
+	idx += 1
+
+	def read_more():
+		nonlocal buf, idx, eof
+		more = file.read(chunk_size)
+		eof = len(more) < chunk_size
+		# Only the undecoded part of the buffer is kept
+		buf = buf[idx:] + more
+		idx = 0
+
+	while True:
+		skip(' \t\r\n,')
+		if idx >= len(buf):
+			if eof:
+				raise ValueError('Unexpected end of JSON array')
+			read_more()
+			continue
+		if buf[idx] == ']':
+			return
+		try:
+			item, end = decoder.raw_decode(buf, idx)
+		except json.JSONDecodeError:
+			if eof:
+				raise
+			# The element runs past the end of the buffer, read some more and try again
+			read_more()
+			continue
+		if not eof and (end == len(buf) or buf[end] not in ' \t\r\n,]'):
+			# A number cut off by the end of the buffer still decodes (e.g. 123 of 12345, or 2500 of 2500.0),
+			# so it's only used once it's followed by something that ends it
+			read_more()
+			continue
+		idx = end
+		yield item
+
+def iter_json_lines(file):
+	for line in file:
+		line = line.strip()
+		if line:
+			yield json.loads(line)
+
+def __parse_iso(ts):
+	dt = datetime.fromisoformat(ts)
+	if dt.tzinfo is None:
+		dt = dt.replace(tzinfo=timezone.utc)
+	return int(dt.timestamp())
+
+def __text(val):
+	if isinstance(val, dict):
+		return val.get('#text') or val.get('name')
+	return val
+
+# Maps a single entry from any of the supported exports to scrobble records.
+# Pages of tracks give several records, unusable entries (podcasts, skipped tracks, etc.) give none.
+def to_records(item):
+	if not isinstance(item, dict):
+		return []
+
+	if 'track' in item and isinstance(item['track'], list):
+		# Page of Last.FM tracks
+		records = []
+		for track in item['track']:
+			records += to_records(track)
+		return records
+
+	if 'ts' in item and 'ms_played' in item:
+		# Spotify extended streaming history, ts is when the track stopped playing
+		if item.get('master_metadata_track_name') is None or item['ms_played'] < MIN_PLAYED_MS:
+			return []
+		return [{
+			'artist': item.get('master_metadata_album_artist_name'),
+			'track': item['master_metadata_track_name'],
+			'timestamp': __parse_iso(item['ts']) - item['ms_played']//1000,
+			'album': item.get('master_metadata_album_album_name')
+		}]
+
+	if 'endTime' in item and 'msPlayed' in item:
+		# Spotify account data streaming history, endTime is in UTC
+		if item.get('trackName') is None or item['msPlayed'] < MIN_PLAYED_MS:
+			return []
+		return [{
+			'artist': item.get('artistName'),
+			'track': item['trackName'],
+			'timestamp': __parse_iso(item['endTime']) - item['msPlayed']//1000
+		}]
+
+	if 'name' in item and 'artist' in item:
+		# Last.FM track, tracks that are currently playing don't have a date
+		date = item.get('date')
+		if date is None:
+			return []
+		album = item.get('album')
+		return [{
+			'artist': __text(item['artist']),
+			'track': item['name'],
+			'timestamp': int(date['uts'] if isinstance(date, dict) else date),
+			'album': __text(album) or None,
+			'mbid': item.get('mbid') or None
+		}]
+
+	if 'artist' in item and 'track' in item and 'timestamp' in item:
+		return [item]
+
+	return []
@@ -1,12 +1,16 @@
-import webbrowser
-import requests
 from time import sleep, time
 from hashlib import md5
+from math import ceil
 from datetime import datetime
 from pathlib import Path
 
-from utils.funcs import get_configs, set_configs, progressbar_batch, get_default
+from utils.funcs import get_configs, set_configs, get_default
 from utils.exceptions import APIResponseError
+from utils.metrics import metrics
+from utils.rate_limit import RateLimiter
+from utils.progress import Progress
+from utils.coalesce import BatchCoalescer
+from utils.dedup import drop_duplicates
 
 # LastFM Statuses
 LFM_STATUS_NO_ERROR = 0
@@ -54,32 +58,41 @@ class LastFM:
 	__API_SECRET = None
 
 	__API_DELAY		  = 1
-	__API_DELAY_STEPS = 0.4
-	__LAST_REQUEST_AT = -1
 
-	def __init__(self, config_file=None, api_key=None, api_secret=None, login=True, user=get_default('PROFILE')):
+	def __init__(self, config_file=None, api_key=None, api_secret=None, login=True, user=None, configs=None, rate_limiter=None):
+		# An already parsed config can be passed in to avoid re-reading the file for every profile
+		if configs is None:
+			if config_file is not None:
+				configs = get_configs(config_file=config_file)
+			else:
+				configs = get_configs()
+
+		# Profiles sharing an API key should share a rate limiter as well
+		if rate_limiter is None:
+			rate_limiter = RateLimiter(self.__API_DELAY)
+		self.__RATE_LIMITER = rate_limiter
+
 		if api_key is not None and api_secret is not None:
 			self.__API_KEY = api_key
 			self.__API_SECRET = api_secret
 		else:
-			if config_file is not None:
-				configs = get_configs('API', config_file=config_file)
-			else:
-				configs = get_configs('API')
+			api_configs = configs.get('API', {})
 			
-			if 'API_KEY' in configs and 'API_SECRET' in configs:
-				self.__API_KEY = configs['API_KEY']
-				self.__API_SECRET = configs['API_SECRET']
+			if 'API_KEY' in api_configs and 'API_SECRET' in api_configs:
+				self.__API_KEY = api_configs['API_KEY']
+				self.__API_SECRET = api_configs['API_SECRET']
 			else:
 				raise Exception('Unable to find API settings in config.toml')
 
 		if self.__API_KEY is None:
 			raise Exception('LastFM API Key cannot be empty.')
 		
+		if user is None:
+			user = get_default('PROFILE', configs)
 		self.__SESSION_NAME = user
 		
 
-		session = get_configs(self.__SESSION_NAME)
+		session = configs.get(self.__SESSION_NAME, {})
 		if 'SESSION_KEY' in session and session['SESSION_KEY'] != '':
 			self.__SESSION = session
 		elif login:
@@ -101,15 +114,15 @@ class LastFM:
 	
 	@property
 	def last_call_time(self):
-		return self.__LAST_REQUEST_AT
+		return self.__RATE_LIMITER.last_call_time
 
 	@property
 	def api_delay_time(self):
-		return self.__API_DELAY
-	
+		return self.__RATE_LIMITER.delay
+
 	@property
-	def api_delay_wait(self):
-		return self.__API_DELAY_STEPS
+	def rate_limiter(self):
+		return self.__RATE_LIMITER
 	
 	@property
 	def user(self):
@@ -118,8 +131,9 @@ class LastFM:
 		else:
 			return 'No user logged in.'
 	
-	def set_new_call_time(self, ts):
-		self.__LAST_REQUEST_AT = ts
+	# Estimates how long the rate limiter will take to let the given number of requests through
+	def estimate_wait(self, num_requests):
+		return self.__RATE_LIMITER.estimate_wait(num_requests)
 
 	# decorator for checking if the user is logged in before doing certain actions
 	def __check_logged_in():
@@ -129,7 +143,7 @@ class LastFM:
 				if not self.is_logged_in:
 					raise Exception('A valid user session is needed for this function.')
 				else:
-					func(*args, **kwargs)
+					return func(*args, **kwargs)
 			return wrapper
 		return deco
 	
@@ -138,21 +152,18 @@ class LastFM:
 		def deco(func):
 			def wrapper(*args, **kwargs):
 				self = args[0]
-				curr_time = time()
-				while(curr_time < (self.last_call_time + self.api_delay_time)):
-					sleep(self.api_delay_wait)
-					curr_time = time()
-				val = func(*args, **kwargs)
-				self.set_new_call_time(curr_time)
-				return val
+				self.rate_limiter.wait()
+				return func(*args, **kwargs)
 			return wrapper
 		return deco
 	
-	# decorator for handling the return value of requests
-	def __handle_req_error(timeout=180, retry=1, silent=False):
+	# decorator for handling the return value of requests.
+	# The wait between retries is multiplied by backoff after each one.
+	def __handle_req_error(timeout=180, retry=1, silent=False, backoff=1):
 		def deco(function):
 			def wrapper(*args, **kwargs):
 				retries = 0
+				wait = timeout
 				while retries < retry:
 					status_code, resp_json, ret_val = function(*args, **kwargs)
 					if status_code == 200:
@@ -161,9 +172,11 @@ class LastFM:
 						raise APIResponseError(resp_json['error'], resp_json['message'])
 					elif resp_json['error'] in LFM_STATUS_RETRY:
 						retries += 1
+						metrics.inc('retries_total', code=resp_json['error'])
 						if not silent:
 							print(f'An error ({resp_json["error"]}) occurred during the last request. Retrying... ({retries} of {retry})')
-						sleep(timeout)
+						sleep(wait)
+						wait *= backoff
 					else:
 						raise APIResponseError(resp_json['error'], resp_json['message'])
 				raise APIResponseError(resp_json['error'], resp_json['message'])
@@ -184,9 +197,11 @@ class LastFM:
 	
 	@__rate_limit()
 	def __send_get_request(self, params={}):
+		import requests
 		url = self.__API_URL
 		params['format'] = 'json'
-		resp = requests.get(url, params)
+		with metrics.stage('http_request', method=params.get('method', ''), verb='GET'):
+			resp = requests.get(url, params)
 
 		status_code = resp.status_code
 		msg = resp.json()
@@ -194,9 +209,11 @@ class LastFM:
 
 	@__rate_limit()
 	def __send_post_request(self, params={}):
+		import requests
 		url = self.__API_URL
 		params['format'] = 'json'
-		resp = requests.post(url, params)
+		with metrics.stage('http_request', method=params.get('method', ''), verb='POST'):
+			resp = requests.post(url, params)
 
 		status_code = resp.status_code
 		msg = resp.json()
@@ -212,13 +229,34 @@ class LastFM:
 		return (status_code, msg, msg.get('token'))
 	
 	def __get_session_from_token(self, token):
+		import webbrowser
 		auth_url = self.__AUTH_URL
 		api_key = self.__API_KEY
 		webbrowser.open_new_tab(f'{auth_url}?api_key={api_key}&token={token}')
 		return self.__get_session_auth_response(token)
 
-	@__handle_req_error(4, 15, True)
-	def __get_session_auth_response(self, token):
+	# Has Last.FM redirect back to a local listener once the user allows access, so the token
+	# can be exchanged straight away. Falls back to polling if the listener can't be started.
+	def __get_session_from_callback(self, port=0, timeout=300):
+		import webbrowser
+		from urllib.parse import quote
+		from utils.auth_callback import AuthCallback
+		try:
+			listener = AuthCallback(port)
+		except OSError as e:
+			print(f'Unable to listen for the login callback ({e}). Waiting for authorization instead.')
+			return self.__get_session_from_token(self.__get_login_token())
+
+		with listener:
+			auth_url = self.__AUTH_URL
+			api_key = self.__API_KEY
+			webbrowser.open_new_tab(f'{auth_url}?api_key={api_key}&cb={quote(listener.url, safe="")}')
+			token = listener.wait(timeout)
+		if token is None:
+			raise APIResponseError(LFM_STATUS_TOKEN_NOT_AUTHORIZED, 'Timed out waiting for authorization.')
+		return self.__exchange_token(token)
+
+	def __request_session(self, token):
 		params = {
 			'method': 'auth.getSession',
 			'api_key': self.__API_KEY,
@@ -231,10 +269,25 @@ class LastFM:
 			ret_val = (msg['session'].get('key'), msg['session'].get('name'))
 		return (status_code, msg, ret_val)
 
-	def login(self):
+	# Polls until the user has authorized the token, waiting longer between each try (up to about a minute and a half)
+	@__handle_req_error(2, 8, True, 1.5)
+	def __get_session_auth_response(self, token):
+		return self.__request_session(token)
+
+	# The token from the callback is already authorized, so it only needs one request
+	@__handle_req_error(0, 1)
+	def __exchange_token(self, token):
+		return self.__request_session(token)
+
+	# callback uses a local listener for the authorization, otherwise Last.FM is polled until it's done.
+	# port is the port for the listener, 0 uses any free one.
+	def login(self, callback=True, port=0):
 		try:
-			token = self.__get_login_token()
-			session_key, user = self.__get_session_from_token(token)
+			if callback:
+				session_key, user = self.__get_session_from_callback(port)
+			else:
+				token = self.__get_login_token()
+				session_key, user = self.__get_session_from_token(token)
 			self.__SESSION = {
 				'SESSION_KEY': session_key,
 				'USER': user
@@ -267,7 +320,9 @@ class LastFM:
 		ind_int = [int(x) for x in ind]
 		for x in range(0, len(ind)):
 			params.update(scrobbles[ind_int[x]].get_api_params(ind[x]))
-		params['api_sig'] = self.__create_signature(params)
+		with metrics.stage('sign'):
+			params['api_sig'] = self.__create_signature(params)
+		metrics.inc('batches_signed_total')
 
 		status_code, msg = self.__send_post_request(params)
 		ret_val = []
@@ -290,33 +345,151 @@ class LastFM:
 		return (status_code, msg, ret_val)
 	
 	@__check_logged_in()
-	def scrobble(self, scrobbles, num_per_batch=50):
-		# Max amount allowed at a time by the LastFM API
-		if num_per_batch > 50:
-			num_per_batch = 50
+	def send_batch(self, batch):
+		# Sends a single batch (max 50) of scrobbles and returns the per-scrobble results
+		with metrics.stage('send_batch'):
+			return self.__scrobble(batch)
 
+	@staticmethod
+	def open_log(log_name='scrob'):
 		curr_date = datetime.fromtimestamp(time())
-		log_file_name = f'scrob_{curr_date.strftime("%y%m%d%H%M%S")}.log'
+		log_file_name = f'{log_name}_{curr_date.strftime("%y%m%d%H%M%S")}.log'
 		log_folder = Path('logs')
-		if not log_folder.exists():
-			log_folder.mkdir()
-		log_file_path = Path('logs') / log_file_name
+		# Several profiles may be scrobbling at once, so this can race with another thread
+		log_folder.mkdir(exist_ok=True)
+		# Logs are named to the second, so one started in the same second gets a number rather than replacing it
+		log_file_path = log_folder / log_file_name
+		num = 1
+		while True:
+			try:
+				return open(log_file_path, 'x', encoding='UTF-8')
+			except FileExistsError:
+				num += 1
+				log_file_path = log_folder / f'{Path(log_file_name).stem}_{num}.log'
+
+	# Writes the results of a batch to the log, returns the number of accepted and ignored scrobbles
+	@staticmethod
+	def log_results(log_file, resp):
+		with metrics.stage('log'):
+			return LastFM.__log_results(log_file, resp)
+
+	@staticmethod
+	def __log_results(log_file, resp):
+		accepted = 0
+		ignored = 0
+		for scrobble in resp:
+			log_file.write(f"{scrobble['status']}: {scrobble['track']} ({scrobble['timestamp']})\n")
+			if scrobble['status'] == 'Accepted':
+				accepted += 1
+				metrics.inc('scrobbles_accepted_total')
+			elif scrobble['status'] == 'Ignored':
+				ignored += 1
+				metrics.inc('scrobbles_ignored_total', code=scrobble['ignore_code'])
+				log_file.write(f"\tIgnore Code: {scrobble['ignore_code']}\n")
+				log_file.write(f"\tIgnore Message: {scrobble['ignore_text']}\n")
+		return (accepted, ignored)
+
+	# Pairs up each result with the index of the scrobble it belongs to in the batch.
+	# Results are matched on their timestamp since the order they come back in isn't guaranteed.
+	@staticmethod
+	def match_results(batch, resp):
+		# Compared as whole seconds, e.g. 1792317750.0 is sent but comes back as '1792317750'
+		by_ts = {}
+		for i, scrobble in enumerate(batch):
+			by_ts.setdefault(int(float(scrobble.timestamp)), []).append(i)
+		matched = []
+		for result in resp:
+			indexes = by_ts.get(int(float(result['timestamp'])), [])
+			matched.append((indexes.pop(0) if len(indexes) > 0 else None, result))
+		return matched
+
+	@__check_logged_in()
+	def scrobble(self, scrobbles, num_per_batch=50, log_name=None, progress=None, results=None):
+		return self.scrobble_sources({'': scrobbles}, num_per_batch, log_name, progress, results)
+
+	# Scrobbles from several sources (e.g. files) are coalesced into full batches rather
+	# than each source sending its own partially filled batch at the end.
+	# sources is either a dict of source name to scrobbles, or a list of (source, scrobble) pairs
+	# which have already been merged (see utils/merge.py.)
+	# dropped is a list of (source, scrobble) pairs dropped while merging the sources, which are written to the log
+	# results can be a ColumnarWriter to export the status of every scrobble sent
+	# dedup can be a DuplicateFilter (see utils/dedup.py) to drop repeated scrobbles before they're sent
+	# duplicates is a dict of source name to the number of repeats already dropped before the sources were given, which is written to the log
+	@__check_logged_in()
+	def scrobble_sources(self, sources, num_per_batch=50, log_name=None, progress=None, results=None, dropped=None, dedup=None, duplicates=None):
+		if log_name is None:
+			log_name = 'scrob'
+
+		if dropped is None:
+			dropped = []
+		if isinstance(sources, dict):
+			total = sum(len(scrobbles) for scrobbles in sources.values())
+			source_names = list(sources)
+			pairs = ((source, scrobble) for source, scrobbles in sources.items() for scrobble in scrobbles)
+		else:
+			total = len(sources)
+			source_names = list(dict.fromkeys(source for source, _ in sources))
+			pairs = sources
+
+		# Repeats are only counted, there could be millions of them
+		# Ones dropped before the sources were given were already counted in the metrics and output
+		print_duplicates = duplicates is None
+		duplicates = dict(duplicates) if duplicates is not None else {}
+		if dedup is not None:
+			def on_duplicate(source, scrobble):
+				duplicates[source] = duplicates.get(source, 0) + 1
+				metrics.inc('duplicates_dropped_total')
+				progress_bar.update(1)
+			pairs = drop_duplicates(pairs, dedup, on_duplicate)
 
 		accepted = 0
 		ignored = 0
+		source_counts = {source: [0, 0] for source in source_names}
+		num_batches = 0
+
+		print(f'Scrobbling {total} tracks to user {self.user}')
+		with self.open_log(log_name) as log_file:
+			log_file.write(f'Scrobbling {total} tracks to user {self.user}\n')
+			schedule = lambda remaining: self.estimate_wait(ceil(remaining/num_per_batch))
+			with Progress(total, schedule=schedule, enabled=progress) as progress_bar:
+				def send(batch, batch_sources):
+					nonlocal accepted, ignored, num_batches
+					num_batches += 1
+					if len(source_names) > 1:
+						counts = {}
+						for source in batch_sources:
+							counts[source] = counts.get(source, 0) + 1
+						counts = ', '.join(f'{k}: {v}' for k, v in counts.items())
+						log_file.write(f'Batch {num_batches} ({counts})\n')
+					resp = self.send_batch(batch)
+					batch_accepted, batch_ignored = self.log_results(log_file, resp)
+					accepted += batch_accepted
+					ignored += batch_ignored
+					for i, result in self.match_results(batch, resp):
+						if i is None:
+							continue
+						source_counts[batch_sources[i]][0 if result['status'] == 'Accepted' else 1] += 1
+						if results is not None:
+							results.write(batch[i], num_batches, batch_sources[i], result['status'], result.get('ignore_code'))
+					progress_bar.update(len(batch))
+
+				coalescer = BatchCoalescer(send, num_per_batch)
+				for source, scrobble in pairs:
+					coalescer.add([scrobble], source)
+				coalescer.close()
 
-		print(f'Scrobbling {len(scrobbles)} tracks to user {self.user}')
-		with open(log_file_path, 'w', encoding='UTF-8') as log_file:
-			log_file.write(f'Scrobbling {len(scrobbles)} tracks to user {self.user}')
-			for batch in progressbar_batch(scrobbles, num_per_batch):
-				resp = self.__scrobble(batch)
-				for scrobble in resp:
-					log_file.write(f"{scrobble['status']}: {scrobble['track']} ({scrobble['timestamp']})\n")
-					if scrobble['status'] == 'Accepted':
-						accepted += 1
-					elif scrobble['status'] == 'Ignored':
-						ignored += 1
-						log_file.write(f"\tIgnore Code: {scrobble['ignore_code']}\n")
-						log_file.write(f"\tIgnore Message: {scrobble['ignore_text']}\n")
+			for source, scrobble in dropped:
+				log_file.write(f'Dropped (overlap): {scrobble.artist} - {scrobble.text} ({scrobble.timestamp}) from {source}\n')
+			if len(source_names) > 1:
+				for source, (source_accepted, source_ignored) in source_counts.items():
+					log_file.write(f'{source}: Accepted: {source_accepted}, Ignored: {source_ignored}\n')
+			if len(dropped) > 0:
+				log_file.write(f'Dropped: {len(dropped)}\n')
+			if len(duplicates) > 0:
+				counts = ', '.join(f'{k}: {v}' for k, v in duplicates.items())
+				log_file.write(f'Duplicates: {sum(duplicates.values())} ({counts})\n')
+				if print_duplicates:
+					print(f'Skipped {sum(duplicates.values())} duplicate scrobbles ({counts}).')
+			log_file.write(f'Batches: {num_batches}\n')
 			log_file.write(f'Accepted: {accepted}\n')
-			log_file.write(f'Ignored: {ignored}\n')
\ No newline at end of file
+			log_file.write(f'Ignored: {ignored}\n')
@@ -1,3 +1,18 @@
+from weakref import WeakValueDictionary
+
+# Artists and albums are shared between every track that has the same one, rather than each track
+# having its own copy. Only kept as long as something is using them. Shared objects shouldn't be changed.
+__shared = WeakValueDictionary()
+
+def get_shared(cls, text='', mbid=None, **kwargs):
+	key = (cls, text, mbid, *sorted(kwargs.items())) if kwargs else (cls, text, mbid)
+	obj = __shared.get(key)
+	if obj is None:
+		obj = cls(text, mbid, **kwargs)
+		__shared[key] = obj
+	return obj
+
+
 class LFMObj():
 	def __init__(self, text='', mbid=None, text_alt='', mbid_alt=''):
 		self.text = text
@@ -63,11 +78,11 @@ class Track(LFMObj):
 			if type(param) == cls:
 				return param
 			elif type(param) == dict:
-				return cls(**param)
+				return get_shared(cls, **param)
 			elif type(param) == str:
-				return cls(param)
+				return get_shared(cls, param)
 			else:
-				return cls(str(param))
+				return get_shared(cls, str(param))
 
 		self.track_artist = get_obj(Artist, artist)
 		self.track_album = get_obj(Album, album)
@@ -89,7 +104,8 @@ class Scrobble(Track):
 		
 		if album_artist != '' and album_artist is not None:
 			if type(album) == Album and album.album_artist != album_artist:
-				album.album_artist = album_artist
+				# The album may be shared, so a different one is used rather than changing it
+				album = {'text': album.text, 'mbid': album.mbid, 'album_artist': album_artist}
 			elif type(album) == dict:
 				album.update({'album_artist': album_artist})
 			else:
@@ -121,6 +137,31 @@ class Scrobble(Track):
 		for k, v in  super().__iter__():
 			yield k, v
 		yield 'timestamp', self.timestamp
+
+	# Flat representation used for storing scrobbles outside of the program (queue, exports, etc.)
+	def to_record(self):
+		has_album = self.track_album is not None
+		return {
+			'artist': self.artist,
+			'track': self.text,
+			'timestamp': self.timestamp,
+			'album': self.album if has_album else None,
+			'album_artist': self.album_artist if has_album else None,
+			'track_no': self.track_no,
+			'mbid': self.mbid,
+			'duration': self.duration
+		}
+
+	@classmethod
+	def from_record(cls, record):
+		album = record.get('album')
+		album_artist = record.get('album_artist') if album is not None else None
+		track_no = record.get('track_no')
+		duration = record.get('duration')
+		return cls(record.get('artist', ''), record.get('track', ''), int(record['timestamp']),
+				   album=album, album_artist=album_artist, mbid=record.get('mbid'),
+				   track_no=track_no if track_no is not None else -1,
+				   duration=duration if duration is not None else -1)
 	
 	def get_api_params(self, ind):
 		params = {}
@@ -147,7 +188,8 @@ class Scrobble(Track):
 			params[f'mbid[{ind}]'] = self.mbid
 
 		# Album Artist
-		if self.track_album != None:
+		# Only sent when known, None values are dropped from the request but would still be signed
+		if self.track_album != None and self.track_album.album_artist not in (None, ''):
 			params[f'albumArtist[{ind}]'] = self.track_album.album_artist
 
 		# Duration
@@ -0,0 +1,192 @@
+import os
+import mmap
+import heapq
+import struct
+import tempfile
+import unicodedata
+from uuid import UUID
+from hashlib import blake2b
+from pathlib import Path
+
+# Offline index of MusicBrainz recordings, used to fill in the mbid and duration of scrobbles.
+#
+# The index file is a header followed by fixed width records sorted by key:
+#	16 byte hash of the normalized 'artist<TAB>track' key
+#	16 byte recording MBID
+#	4 byte recording length in milliseconds (0 if unknown)
+# It's memory mapped, so lookups are a binary search over the file without loading it.
+
+MAGIC = b'LFMMBI01'
+RECORD = struct.Struct('>16s16sI')
+
+def normalize(text):
+	text = unicodedata.normalize('NFKC', text)
+	text = text.replace('’', "'").replace('‘', "'").replace('“', '"').replace('”', '"')
+	return ' '.join(text.casefold().split())
+
+def make_key(artist, track):
+	return blake2b(f'{normalize(artist)}\t{normalize(track)}'.encode(), digest_size=16).digest()
+
+class MBIndex:
+	def __init__(self, fname):
+		self.fpath = Path(fname)
+		self.__file = open(self.fpath, 'rb')
+		self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.__map[:len(MAGIC)] != MAGIC:
+			self.close()
+			raise Exception(f'{self.fpath} is not a MusicBrainz index file.')
+		self.__count = (len(self.__map) - len(MAGIC)) // RECORD.size
+
+	def __len__(self):
+		return self.__count
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		self.__map.close()
+		self.__file.close()
+
+	def __key_at(self, i):
+		offset = len(MAGIC) + i*RECORD.size
+		return self.__map[offset:offset+16]
+
+	def __record_at(self, i):
+		offset = len(MAGIC) + i*RECORD.size
+		_, mbid, length = RECORD.unpack_from(self.__map, offset)
+		return (str(UUID(bytes=mbid)), length if length > 0 else None)
+
+	# Index of the first record with a key >= the one given, searching from lo onwards
+	def __lower_bound(self, key, lo=0):
+		hi = self.__count
+		while lo < hi:
+			mid = (lo+hi) // 2
+			if self.__key_at(mid) < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	def lookup(self, artist, track):
+		key = make_key(artist, track)
+		i = self.__lower_bound(key)
+		if i < self.__count and self.__key_at(i) == key:
+			return self.__record_at(i)
+		return None
+
+	# Looks up a whole batch at once. The keys are searched in sorted order so each
+	# search only has to look at the part of the index after the previous match.
+	def lookup_many(self, pairs):
+		keys = [make_key(artist, track) for artist, track in pairs]
+		results = [None]*len(keys)
+		lo = 0
+		for i in sorted(range(len(keys)), key=lambda x: keys[x]):
+			lo = self.__lower_bound(keys[i], lo)
+			if lo < self.__count and self.__key_at(lo) == keys[i]:
+				results[i] = self.__record_at(lo)
+		return results
+
+	# Fills in the mbid and duration of any scrobbles that don't have them. Returns the number enriched.
+	def enrich(self, scrobbles):
+		todo = [x for x in scrobbles if x.mbid is None or x.duration == -1]
+		enriched = 0
+		for scrobble, result in zip(todo, self.lookup_many([(x.artist, x.text) for x in todo])):
+			if result is None:
+				continue
+			mbid, length = result
+			if scrobble.mbid is None:
+				scrobble.mbid = mbid
+			if scrobble.duration == -1 and length is not None:
+				scrobble.duration = length // 1000
+			enriched += 1
+		return enriched
+
+
+# Reads a table from a MusicBrainz dump (PostgreSQL COPY format)
+def __read_dump_table(fpath):
+	def unescape(val):
+		if val == '\\N':
+			return None
+		if '\\' not in val:
+			return val
+		return val.replace('\\t', '\t').replace('\\n', '\n').replace('\\r', '\r').replace('\\\\', '\\')
+
+	with open(fpath, 'r', encoding='utf-8') as f:
+		for line in f:
+			yield [unescape(x) for x in line.rstrip('\n').split('\t')]
+
+# Yields (artist, track, mbid, length) for every recording in the source
+def __read_recordings(source):
+	source = Path(source)
+	if source.is_dir():
+		# MusicBrainz dump directory (mbdump), recordings only refer to their artist credit by id
+		credits = {}
+		for row in __read_dump_table(source/'artist_credit'):
+			credits[row[0]] = row[1]
+		for row in __read_dump_table(source/'recording'):
+			artist = credits.get(row[3])
+			if artist is None:
+				continue
+			yield (artist, row[2], row[1], int(row[4]) if row[4] else 0)
+	else:
+		# Tab separated artist, track, mbid and (optionally) length in milliseconds
+		with open(source, 'r', encoding='utf-8') as f:
+			for line in f:
+				row = line.rstrip('\n').split('\t')
+				if len(row) < 3:
+					continue
+				yield (row[0], row[1], row[2], int(row[3]) if len(row) > 3 and row[3] else 0)
+
+def __read_run(fpath):
+	with open(fpath, 'rb') as f:
+		while True:
+			data = f.read(RECORD.size)
+			if len(data) < RECORD.size:
+				return
+			yield RECORD.unpack(data)
+
+def build_index(source, out_file, chunk_size=1000000):
+	# Sorted runs are written to temp files and merged, so the whole dump is never held in memory
+	runs = []
+	with tempfile.TemporaryDirectory() as temp_dir:
+		def write_run(records):
+			records.sort()
+			run_path = Path(temp_dir)/f'run_{len(runs)}'
+			with open(run_path, 'wb') as f:
+				for record in records:
+					f.write(RECORD.pack(*record))
+			runs.append(run_path)
+
+		records = []
+		for artist, track, mbid, length in __read_recordings(source):
+			records.append((make_key(artist, track), UUID(mbid).bytes, length))
+			if len(records) >= chunk_size:
+				write_run(records)
+				records = []
+		if len(records) > 0:
+			write_run(records)
+
+		count = 0
+		last_key = None
+		with open(out_file, 'wb') as out:
+			out.write(MAGIC)
+			for key, mbid, length in heapq.merge(*[__read_run(x) for x in runs]):
+				# Only one recording is kept per artist and track
+				if key == last_key:
+					continue
+				last_key = key
+				out.write(RECORD.pack(key, mbid, length))
+				count += 1
+	return count
+
+
+if __name__ == '__main__':
+	from argparse import ArgumentParser
+	parser = ArgumentParser(description='Builds a MusicBrainz index for filling in the mbid and duration of scrobbles.')
+	parser.add_argument('source', help='MusicBrainz dump directory (containing the recording and artist_credit tables) or a tab separated file of artist, track, mbid and length.')
+	parser.add_argument('index', help='Index file to write.')
+	args = parser.parse_args()
+	print(f'Indexed {build_index(args.source, args.index)} recordings to {os.path.abspath(args.index)}')
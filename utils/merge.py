@@ -0,0 +1,61 @@
+MERGE_POLICIES = ['keep', 'keep-first', 'drop', 'shift']
+
+# Merges several scrobble lists into a single time ordered stream of (source, scrobble) pairs.
+# The files are already fully read by the time they're merged, so this is a single stable sort.
+# Scrobbles with the same timestamp stay in the order of their sources.
+#
+# Scrobbles from different sources that start within min_gap seconds of each other overlap.
+# Overlaps are handled with one of the policies:
+#	keep:		Nothing is done, both are kept
+#	keep-first:	The earlier scrobble is kept and the later one is dropped
+#	drop:		All of the overlapping scrobbles are dropped
+#	shift:		The later scrobble is moved to min_gap seconds after the earlier one
+def merge_scrobbles(sources, policy='keep', min_gap=30, on_drop=None):
+	if policy not in MERGE_POLICIES:
+		raise Exception(f'Unknown merge policy {policy}. Expected one of: {", ".join(MERGE_POLICIES)}')
+
+	pairs = [(source, scrobble) for source, scrobbles in sources.items() for scrobble in scrobbles]
+	pairs.sort(key=lambda x: x[1].timestamp)
+
+	def dropped(source, scrobble):
+		if on_drop is not None:
+			on_drop(source, scrobble)
+
+	# Only needed for the drop policy, which can't tell whether to keep a scrobble until the next one is seen
+	held = None
+	held_overlaps = False
+	prev = None
+
+	for source, scrobble in pairs:
+		overlaps = prev is not None and prev[0] != source and scrobble.timestamp < prev[1].timestamp + min_gap
+		if policy == 'shift' and prev is not None and scrobble.timestamp < prev[1].timestamp:
+			# Pushed back by an earlier shift, so it has to move along with it to stay in order
+			overlaps = True
+		if overlaps and policy == 'keep-first':
+			dropped(source, scrobble)
+			continue
+		if overlaps and policy == 'shift':
+			scrobble.timestamp = prev[1].timestamp + min_gap
+
+		if policy == 'drop':
+			if held is not None:
+				if overlaps:
+					dropped(*held)
+					held_overlaps = True
+				elif held_overlaps:
+					dropped(*held)
+					held_overlaps = False
+				else:
+					yield held
+			held = (source, scrobble)
+			prev = held
+			continue
+
+		prev = (source, scrobble)
+		yield prev
+
+	if held is not None:
+		if held_overlaps:
+			dropped(*held)
+		else:
+			yield held
@@ -0,0 +1,170 @@
+import json
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+
+# Default histogram buckets in seconds. Covers everything from a single line parse
+# up to a long wait on a retried request.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Histogram:
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = tuple(buckets)
+		self.counts = [0]*len(self.buckets)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, val):
+		self.count += 1
+		self.sum += val
+		for i, bound in enumerate(self.buckets):
+			if val <= bound:
+				self.counts[i] += 1
+				break
+
+	def to_dict(self):
+		# Cumulative counts to match the prometheus representation
+		cumulative = []
+		running = 0
+		for count in self.counts:
+			running += count
+			cumulative.append(running)
+		return {
+			'count': self.count,
+			'sum': self.sum,
+			'buckets': dict(zip([str(b) for b in self.buckets], cumulative))
+		}
+
+
+class Metrics:
+	def __init__(self, prefix='lfm_scrobbler'):
+		self.prefix = prefix
+		self.__lock = threading.Lock()
+		self.__counters = {}
+		self.__histograms = {}
+		self.__hooks = []
+		self.__server = None
+
+	# Labels are stored as a sorted tuple of (key, value) pairs so they can be used as dict keys
+	@staticmethod
+	def __label_key(labels):
+		return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+	def inc(self, name, val=1, **labels):
+		key = (name, self.__label_key(labels))
+		with self.__lock:
+			self.__counters[key] = self.__counters.get(key, 0) + val
+
+	def observe(self, name, val, **labels):
+		key = (name, self.__label_key(labels))
+		with self.__lock:
+			if key not in self.__histograms:
+				self.__histograms[key] = Histogram()
+			self.__histograms[key].observe(val)
+
+	def get(self, name, **labels):
+		return self.__counters.get((name, self.__label_key(labels)), 0)
+
+	def reset(self):
+		with self.__lock:
+			self.__counters = {}
+			self.__histograms = {}
+
+	# Hooks are called as hook(stage, event) where event is either 'enter' or 'exit'.
+	# This is what allows a profiler (or anything else) to be attached to any stage.
+	def add_hook(self, hook):
+		self.__hooks.append(hook)
+
+	def remove_hook(self, hook):
+		if hook in self.__hooks:
+			self.__hooks.remove(hook)
+
+	@contextmanager
+	def stage(self, name, **labels):
+		for hook in self.__hooks:
+			hook(name, 'enter')
+		start = perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(f'{name}_seconds', perf_counter() - start, **labels)
+			for hook in reversed(self.__hooks):
+				hook(name, 'exit')
+
+	@staticmethod
+	def __format_labels(labels, extra=()):
+		labels = list(labels) + list(extra)
+		if len(labels) == 0:
+			return ''
+		label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+		return f'{{{label_str}}}'
+
+	def to_prometheus(self):
+		lines = []
+		with self.__lock:
+			counters = dict(self.__counters)
+			histograms = {k: v.to_dict() for k, v in self.__histograms.items()}
+
+		seen = set()
+		for (name, labels), val in sorted(counters.items()):
+			full_name = f'{self.prefix}_{name}'
+			if full_name not in seen:
+				seen.add(full_name)
+				lines.append(f'# TYPE {full_name} counter')
+			lines.append(f'{full_name}{self.__format_labels(labels)} {val}')
+
+		for (name, labels), hist in sorted(histograms.items()):
+			full_name = f'{self.prefix}_{name}'
+			if full_name not in seen:
+				seen.add(full_name)
+				lines.append(f'# TYPE {full_name} histogram')
+			for bound, count in hist['buckets'].items():
+				lines.append(f'{full_name}_bucket{self.__format_labels(labels, [("le", bound)])} {count}')
+			lines.append(f'{full_name}_bucket{self.__format_labels(labels, [("le", "+Inf")])} {hist["count"]}')
+			lines.append(f'{full_name}_sum{self.__format_labels(labels)} {hist["sum"]}')
+			lines.append(f'{full_name}_count{self.__format_labels(labels)} {hist["count"]}')
+		return '\n'.join(lines) + '\n'
+
+	def to_dict(self):
+		with self.__lock:
+			counters = [{'name': name, 'labels': dict(labels), 'value': val}
+						for (name, labels), val in self.__counters.items()]
+			histograms = [{'name': name, 'labels': dict(labels), **hist.to_dict()}
+						  for (name, labels), hist in self.__histograms.items()]
+		return {'counters': counters, 'histograms': histograms}
+
+	def dump_json(self, fname):
+		with open(fname, 'w', encoding='UTF-8') as f:
+			json.dump(self.to_dict(), f, indent='\t')
+
+	def serve(self, port, host='127.0.0.1'):
+		# Only loaded when metrics are actually being served
+		from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+		metrics = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = metrics.to_prometheus().encode()
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			# Scrape requests shouldn't end up in the progress output
+			def log_message(self, format, *args):
+				pass
+
+		self.__server = ThreadingHTTPServer((host, int(port)), Handler)
+		thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+		thread.start()
+		return self.__server
+
+	def stop(self):
+		if self.__server is not None:
+			self.__server.shutdown()
+			self.__server = None
+
+
+# Shared instance used throughout the program
+metrics = Metrics()
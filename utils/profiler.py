@@ -0,0 +1,148 @@
+import sys
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from io import StringIO
+from time import time
+from pathlib import Path
+from datetime import datetime
+
+from utils.metrics import metrics
+from utils.lfm_objects import Scrobble
+
+# Profiles a run of the program and writes the results to the log directory:
+#	profile_<date>.pstats		cProfile stats (e.g. for snakeviz or pstats)
+#	profile_<date>.collapsed	Sampled stacks in the collapsed format used by flamegraph.pl/speedscope,
+#								with the stage the sample was taken in as the root frame
+#	profile_<date>_alloc.txt	Top allocations at every batch boundary and for the whole run
+#	profile_<date>_stages.txt	Time spent in each stage
+#
+# Stages are the ones reported through utils/metrics.py (config_load, read, sign, http_request, log, etc.)
+class RunProfiler:
+	# Allocation snapshots are taken whenever one of these stages finishes
+	SNAPSHOT_STAGES = ['read', 'send_batch']
+
+	def __init__(self, out_dir='logs', interval=0.005, top=10):
+		self.out_dir = Path(out_dir)
+		self.interval = interval
+		self.top = top
+		curr_date = datetime.fromtimestamp(time())
+		self.prefix = self.out_dir / f'profile_{curr_date.strftime("%y%m%d%H%M%S")}'
+
+		self.__profile = cProfile.Profile()
+		self.__stages = {}
+		self.__samples = {}
+		self.__stop = threading.Event()
+		self.__sampler = None
+		# Guards the stages, and the snapshot count and last snapshot, which are updated from every thread
+		self.__lock = threading.Lock()
+		self.__alloc_lock = threading.Lock()
+		self.__first_snapshot = None
+		self.__last_snapshot = None
+		self.__alloc_file = None
+		self.__num_snapshots = 0
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.stop()
+
+	def start(self):
+		self.out_dir.mkdir(exist_ok=True)
+		self.__alloc_file = open(f'{self.prefix}_alloc.txt', 'w', encoding='UTF-8')
+		tracemalloc.start()
+		self.__first_snapshot = self.__last_snapshot = tracemalloc.take_snapshot()
+		metrics.add_hook(self.__hook)
+		self.__sampler = threading.Thread(target=self.__sample_loop, daemon=True)
+		self.__sampler.start()
+		self.__profile.enable()
+
+	def stop(self):
+		self.__profile.disable()
+		self.__stop.set()
+		self.__sampler.join()
+		metrics.remove_hook(self.__hook)
+
+		final = tracemalloc.take_snapshot()
+		tracemalloc.stop()
+		self.__write_allocs('Whole run', final, self.__first_snapshot)
+		self.__alloc_file.close()
+
+		self.__profile.dump_stats(f'{self.prefix}.pstats')
+		self.__write_collapsed()
+		self.__write_stages()
+		print(f'Profile written to {self.prefix.resolve()}.*')
+
+	# Keeps track of the stages each thread is currently in
+	def __hook(self, stage, event):
+		tid = threading.get_ident()
+		with self.__lock:
+			stack = self.__stages.setdefault(tid, [])
+			if event == 'enter':
+				stack.append(stage)
+			elif len(stack) > 0:
+				stack.pop()
+		if event == 'exit' and stage in self.SNAPSHOT_STAGES:
+			snapshot = tracemalloc.take_snapshot()
+			with self.__lock:
+				self.__num_snapshots += 1
+				num = self.__num_snapshots
+				previous = self.__last_snapshot
+				self.__last_snapshot = snapshot
+			self.__write_allocs(f'{stage} #{num}', snapshot, previous)
+
+	def __write_allocs(self, label, snapshot, previous):
+		filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+		stats = snapshot.filter_traces(filters).compare_to(previous.filter_traces(filters), 'lineno')
+		with self.__alloc_lock:
+			self.__alloc_file.write(f'{label}\n')
+			for stat in stats[:self.top]:
+				self.__alloc_file.write(f'\t{stat}\n')
+			self.__alloc_file.flush()
+
+	def __sample_loop(self):
+		own = threading.get_ident()
+		while not self.__stop.wait(self.interval):
+			with self.__lock:
+				stages = {tid: ';'.join(stack) for tid, stack in self.__stages.items()}
+			for tid, frame in sys._current_frames().items():
+				if tid == own:
+					continue
+				stack = []
+				while frame is not None:
+					code = frame.f_code
+					stack.append(f'{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})')
+					frame = frame.f_back
+				stack.reverse()
+				root = stages.get(tid) or 'other'
+				key = ';'.join([root] + stack)
+				self.__samples[key] = self.__samples.get(key, 0) + 1
+
+	def __write_collapsed(self):
+		with open(f'{self.prefix}.collapsed', 'w', encoding='UTF-8') as f:
+			for stack, count in sorted(self.__samples.items()):
+				f.write(f'{stack} {count}\n')
+
+	def __write_stages(self):
+		histograms = metrics.to_dict()['histograms']
+		stage_times = {}
+		for hist in histograms:
+			if hist['name'].endswith('_seconds'):
+				name = hist['name'][:-len('_seconds')]
+				count, total = stage_times.get(name, (0, 0))
+				stage_times[name] = (count + hist['count'], total + hist['sum'])
+
+		# Building the scrobbles happens inside of read, so it's taken from the profile instead
+		stats = pstats.Stats(self.__profile, stream=StringIO())
+		init = Scrobble.__init__.__code__
+		for (filename, lineno, func), (_, ncalls, _, cumulative, _) in stats.stats.items():
+			if filename == init.co_filename and lineno == init.co_firstlineno and func == '__init__':
+				stage_times['scrobble_build (within read)'] = (ncalls, cumulative)
+
+		with open(f'{self.prefix}_stages.txt', 'w', encoding='UTF-8') as f:
+			f.write(f"{'Stage':<32}{'Calls':>10}{'Total (s)':>14}\n")
+			for name, (count, total) in sorted(stage_times.items(), key=lambda x: x[1][1], reverse=True):
+				f.write(f'{name:<32}{count:>10}{total:>14.4f}\n')
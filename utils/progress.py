@@ -0,0 +1,86 @@
+import sys
+import threading
+from time import time
+
+class Progress:
+	def __init__(self, total=None, prefix='', size=60, out=sys.stdout, refresh=0.25, schedule=None, enabled=None):
+		self.total = total
+		self.prefix = prefix
+		self.size = size
+		self.out = out
+		self.refresh = refresh
+		# Optional callable, schedule(remaining_items) -> seconds, used to estimate the
+		# remaining time from an external schedule (e.g. the API rate limiter).
+		self.schedule = schedule
+		self.count = 0
+
+		# Progress output only makes sense for a terminal. When running under cron or
+		# systemd it would only fill up the logs, so it turns itself off.
+		if enabled is None:
+			enabled = hasattr(out, 'isatty') and out.isatty()
+		self.enabled = enabled
+
+		self.__start = None
+		self.__stop = threading.Event()
+		self.__thread = None
+		self.__last_rendered = None
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def start(self):
+		self.__start = time()
+		if self.enabled and self.__thread is None:
+			self.__thread = threading.Thread(target=self.__run, daemon=True)
+			self.__thread.start()
+
+	def update(self, n=1):
+		# Only a counter update, rendering is done by the background thread
+		self.count += n
+
+	def close(self):
+		if self.__thread is not None:
+			self.__stop.set()
+			self.__thread.join()
+			self.__thread = None
+			self.__render()
+			print('', file=self.out, flush=True)
+
+	def __run(self):
+		while not self.__stop.wait(self.refresh):
+			self.__render()
+
+	def eta(self):
+		if self.total is None or self.count == 0:
+			return None
+		remaining = max(self.total - self.count, 0)
+		elapsed_est = ((time() - self.__start) / self.count) * remaining
+		if self.schedule is None:
+			return elapsed_est
+		# The schedule is a lower bound, but it can be slower than that if requests take a while
+		return max(self.schedule(remaining), elapsed_est)
+
+	def __format(self):
+		if self.total is None:
+			elapsed = time() - self.__start
+			rate = self.count / elapsed if elapsed > 0 else 0
+			return f'{self.prefix}{self.count} done ({rate:.1f}/s)    '
+
+		x = int(self.size*self.count/self.total) if self.total > 0 else self.size
+		eta = self.eta()
+		if eta is None:
+			time_str = '--:--.-'
+		else:
+			mins, sec = divmod(eta, 60) # limited to minutes
+			time_str = f'{int(mins):02d}:{sec:04.1f}'
+		return f"{self.prefix}[{u'█'*x}{('.'*(self.size-x))}] {self.count}/{self.total} Est wait {time_str}    "
+
+	def __render(self):
+		line = self.__format()
+		if line != self.__last_rendered:
+			self.__last_rendered = line
+			print(line, end='\r', file=self.out, flush=True)
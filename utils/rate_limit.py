@@ -0,0 +1,32 @@
+import threading
+from time import sleep, time
+
+from utils.metrics import metrics
+
+# Rate limiter that can be shared between several LastFM objects (e.g. multiple
+# profiles using the same API key) so they all stay within the same budget.
+class RateLimiter:
+	def __init__(self, delay=1):
+		self.delay = delay
+		self.last_call_time = -1
+		self.__lock = threading.Lock()
+
+	# Reserves the next free slot and sleeps until it comes up.
+	# Reserving under the lock means concurrent callers each get their own slot.
+	def wait(self):
+		with self.__lock:
+			curr_time = time()
+			slot = max(curr_time, self.last_call_time + self.delay)
+			self.last_call_time = slot
+		wait_time = slot - curr_time
+		if wait_time > 0:
+			sleep(wait_time)
+		metrics.observe('rate_limit_wait_seconds', wait_time)
+		return wait_time
+
+	# Estimates how long it will take to let the given number of requests through
+	def estimate_wait(self, num_requests):
+		if num_requests <= 0:
+			return 0
+		next_allowed = max(self.last_call_time + self.delay - time(), 0)
+		return next_allowed + (num_requests-1)*self.delay
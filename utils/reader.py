@@ -1,29 +1,57 @@
 from pathlib import Path
+from contextlib import nullcontext, contextmanager
+from collections import OrderedDict
+import io
 import re
-from pendulum import now, local, from_timestamp
-import requests
-from bs4 import BeautifulSoup
+import json
 import hashlib
 
 from utils.lfm_objects import Scrobble
 from utils.funcs import get_path_obj, get_configs
+from utils.metrics import metrics
+from utils.artist_index import ArtistIndex
+from utils.json_import import iter_json_array, iter_json_lines, to_records
 
 class timer:
 	date_re = r'([0-9\/]+) ([0-9:]+)'
 	time_re = r'([0-9:]+)'
-	tz = now().tz
-	curr_year = str(now().year)
-	min_age = int(now().subtract(days=14).timestamp())
+	# Time zone, year and the oldest accepted timestamp are only worked out when first needed
+	# so importing the reader doesn't have to load pendulum
+	tz = None
+	curr_year = None
+	min_age = None
 	ts = -1
 	last_ts = -1
 	increment = -1
 
+	@staticmethod
+	def init_now():
+		if timer.tz is None:
+			from pendulum import now
+			curr_dt = now()
+			timer.tz = curr_dt.tz
+			timer.curr_year = str(curr_dt.year)
+			timer.min_age = int(curr_dt.subtract(days=14).timestamp())
+
+	# Long running modes (serve, work) read files long after they started, so the oldest accepted
+	# timestamp and the current year are worked out again for each file
+	@staticmethod
+	def reset_now():
+		timer.tz = None
+
 	@staticmethod
 	def set_increment(increment):
-		timer.increment = increment
+		timer.increment = float(increment)
+
+	# Seconds between tracks. Timestamps are kept as whole seconds, the same as Last.FM returns them.
+	@staticmethod
+	def step():
+		return int(round(timer.increment*60))
 
 	@staticmethod
 	def set_ts(dt):
+		from pendulum import now, local, from_timestamp
+		timer.init_now()
 		try:
 			dt, tm = re.match(timer.date_re, dt).groups()
 		except AttributeError:
@@ -62,21 +90,51 @@ class timer:
 		if timer.increment == -1:
 			raise Exception('Increment has not been set yet!')
 		timer.last_ts = timer.ts
-		timer.ts += timer.increment*60
+		timer.ts += timer.step()
 		return timer.ts
 
 	@staticmethod
 	def from_timestamp(ts=None):
+		from pendulum import from_timestamp
+		timer.init_now()
 		if ts is None:
 			ts = timer.ts
 		return from_timestamp(ts, timer.tz)
 
 class Reader:
-	implemented_ext = ['.txt', '.csv']
-
-	def __init__(self, increment, csv_separator):
+	implemented_ext = ['.txt', '.csv', '.json', '.jsonl']
+	# Any of the above can also be compressed, e.g. tracklist.txt.gz
+	compressed_ext = ['.gz', '.xz', '.zst']
+	# Compressed files are detected by their magic bytes as well, in case they weren't named for it
+	__magic = {b'\x1f\x8b': '.gz', b'\xfd7zXZ\x00': '.xz', b'\x28\xb5\x2f\xfd': '.zst'}
+	# Compressed files are read in large chunks, since decompressing small reads is slow
+	__read_buffer = 1024*1024
+	# Number of track lines whose splits are remembered, so repeated lines aren't split again
+	split_memo_size = 10000
+	# Hyphen, en dash, or em dash with a space on either side
+	__dash_re = re.compile(' (?=[-–—] )')
+
+	def __init__(self, increment, csv_separator, interactive=True, artist_seed=None, deferred=False, count_only=False):
 		timer.set_increment(increment)
 		self.csv_separator = csv_separator
+		# When counting only, the files are validated without building any scrobbles.
+		# Batches only keep their count and first and last timestamps.
+		self.count_only = count_only
+		# When not interactive, lines that can't be split raise an error instead of prompting
+		self.interactive = interactive and not count_only
+		# When deferred, lines that can't be split are all reviewed together once the file is parsed
+		self.deferred = deferred or count_only
+		self.artist_seed = artist_seed
+		self.__artist_index = None
+		# Kept across files, the same tracks tend to come up in more than one
+		self.__split_memo = OrderedDict()
+
+	# Built on first use so files without any ambiguous lines don't pay for it
+	@property
+	def artist_index(self):
+		if self.__artist_index is None:
+			self.__artist_index = ArtistIndex.build(seed_file=self.artist_seed)
+		return self.__artist_index
 	
 	class __scrobbleBatch:
 		def __init__(self):
@@ -90,45 +148,153 @@ class Reader:
 			if len(self.scrobbles) == 0:
 				return None
 			else:
-				return from_timestamp(self.scrobbles[0].timestamp, timer.tz)
+				return timer.from_timestamp(self.scrobbles[0].timestamp)
 
 		@property
 		def end(self):
 			if len(self.scrobbles) == 0:
 				return None
 			else:
-				return from_timestamp(self.scrobbles[-1].timestamp, timer.tz)
+				return timer.from_timestamp(self.scrobbles[-1].timestamp)
 			
 		def add_scrobble(self, scrobble):
 			self.scrobbles.append(scrobble)
 
 		def add_scrobbles(self, scrobbles):
 			self.scrobbles += scrobbles
+
+		def __len__(self):
+			return len(self.scrobbles)
+
+	class __countBatch:
+		def __init__(self):
+			self.count = 0
+			self.first_ts = None
+			self.last_ts = None
+
+		@property
+		def start(self):
+			return timer.from_timestamp(self.first_ts) if self.count > 0 else None
+
+		@property
+		def end(self):
+			return timer.from_timestamp(self.last_ts) if self.count > 0 else None
+
+		def add_timestamp(self, ts):
+			if self.count == 0:
+				self.first_ts = ts
+			self.last_ts = ts
+			self.count += 1
+
+		def add_scrobbles(self, scrobbles):
+			for scrobble in scrobbles:
+				self.add_timestamp(scrobble.timestamp)
+
+		def __len__(self):
+			return self.count
+
+	def __new_batch(self):
+		return self.__countBatch() if self.count_only else self.__scrobbleBatch()
+
+	@staticmethod
+	def __make_scrobble(artist, track, ts, **kwargs):
+		metrics.inc('scrobbles_built_total')
+		return Scrobble(artist, track, ts, **kwargs)
+
+	# Adds the track to the batch, or just counts it when only validating
+	def __add_track(self, batch, artist, track, ts, **kwargs):
+		if self.count_only:
+			# Same checks the Scrobble would do
+			if artist == '':
+				raise Exception('Artist name cannot be empty for a scrobble!')
+			if track == '':
+				raise Exception('Track name cannot be empty for a scrobble!')
+			batch.add_timestamp(ts)
+		else:
+			batch.add_scrobble(self.__make_scrobble(artist, track, ts, **kwargs))
 	
 	def read(self, fname):
 		fpath = get_path_obj(fname)
 
-		if fpath.suffix not in self.implemented_ext:
+		# The format of a compressed file comes from the suffix before the compression one
+		suffix = fpath.suffix
+		if suffix.lower() in self.compressed_ext:
+			suffix = Path(fpath.stem).suffix
+		if suffix not in self.implemented_ext:
 			raise Exception(f'Reader not yet implemented for {fpath.suffix} files.')
 		
-		if fpath.suffix.lower() == '.txt':
-			return self.__txt(fpath)
-		elif fpath.suffix.lower() == '.csv':
-			return self.__csv(fpath)
+		timer.reset_now()
+		with metrics.stage('read', format=suffix.lower()):
+			if suffix.lower() == '.txt':
+				return self.__txt(fpath)
+			elif suffix.lower() == '.csv':
+				return self.__csv(fpath)
+			elif suffix.lower() in ['.json', '.jsonl']:
+				return self.__json(fpath, suffix.lower() == '.jsonl')
+
+	def read_string(self, text, ext):
+		# Parses a tracklist that's already in memory (e.g. sent to the service) instead of a file
+		ext = ext.lower() if ext.startswith('.') else f'.{ext.lower()}'
+		if ext not in self.implemented_ext:
+			raise Exception(f'Reader not yet implemented for {ext} files.')
+
+		timer.reset_now()
+		with metrics.stage('read', format=ext):
+			if ext == '.txt':
+				return self.__txt(io.StringIO(text))
+			elif ext == '.csv':
+				return self.__csv(io.StringIO(text, newline=''))
+			elif ext in ['.json', '.jsonl']:
+				return self.__json(io.StringIO(text), ext == '.jsonl')
+
+	# Opens the path given (decompressing it if needed) or passes through an already open file object
+	@staticmethod
+	def __open(source, **kwargs):
+		if isinstance(source, Path):
+			compression = Reader.__compression(source)
+			if compression is not None:
+				return Reader.__open_compressed(source, compression, **kwargs)
+			return open(source, 'r', **kwargs)
+		return nullcontext(source)
+
+	@staticmethod
+	def __compression(fpath):
+		with open(fpath, 'rb') as f:
+			head = f.read(8)
+		for magic, compression in Reader.__magic.items():
+			if head.startswith(magic):
+				return compression
+		return None
+
+	# Decompresses the file as it's read, so nothing is written to disk
+	@staticmethod
+	@contextmanager
+	def __open_compressed(fpath, compression, **kwargs):
+		with open(fpath, 'rb', buffering=Reader.__read_buffer) as raw:
+			if compression == '.gz':
+				import gzip
+				stream = gzip.GzipFile(fileobj=raw)
+			elif compression == '.xz':
+				import lzma
+				stream = lzma.LZMAFile(raw)
+			elif compression == '.zst':
+				try:
+					import zstandard
+				except ImportError:
+					raise Exception(f'zstandard is needed to read {fpath}. It can be installed with: pip install zstandard')
+				stream = zstandard.ZstdDecompressor().stream_reader(raw)
+			with io.TextIOWrapper(io.BufferedReader(stream, Reader.__read_buffer), **kwargs) as text:
+				yield text
 
 	def __txt(self, fpath):
-		current_batch = self.__scrobbleBatch()
+		current_batch = self.__new_batch()
 		scrobble_batches = []
 		album = None
 		album_artist = None
 
 		def find_dashes(source):
-			dashes = [' - ', ' – ', ' — ']
-			indexes = []
-			for dash in dashes:
-				indexes += [(i.start(), i.end()) for i in re.finditer(dash, source)]
-			indexes.sort()
-			return indexes
+			# Lookahead so dashes sharing a space are all found, like separate searches for each would
+			return [(i.start(), i.start()+3) for i in Reader.__dash_re.finditer(source)]
 
 		def highlight_dashes(source, splits):
 			h_track = source
@@ -144,16 +310,96 @@ class Reader:
 			artist, track = [source[:splits[0]],source[splits[1]:]]
 			return (artist, track)
 
-		with open(fpath, 'r', encoding='utf-8') as tracklist:
+		# Tries to split the line without asking the user.
+		# Returns the (artist, track) split or None along with the line and splits to ask about.
+		def auto_split(line):
+			# Lines which split on their own are remembered, the same split is used (and shared) for repeats.
+			# The album artist is part of the key since it's used for lines without a dash.
+			memo = self.__split_memo
+			key = (album_artist, line)
+			result = memo.get(key)
+			if result is not None:
+				memo.move_to_end(key)
+				return result
+			result = find_split(line)
+			if result[0] is not None:
+				memo[key] = result
+				if len(memo) > self.split_memo_size:
+					memo.popitem(last=False)
+			return result
+
+		def find_split(line):
+			# Attempt to split the line on a hyphen, en dash, or em dash
+			splits = find_dashes(line)
+			if len(splits) == 0 and album_artist is not None:
+				# No dashes found
+				# If this is in an album, default to the Album Artist and rerun the splits
+				line = f'{album_artist} - {line}'
+				splits = find_dashes(line)
+			if len(splits) != 1:
+				# Check if only one split comes after a known artist
+				resolved = self.artist_index.resolve(line, splits)
+				if resolved is not None:
+					line, splits = resolved
+			if len(splits) == 1:
+				return (split_on_dash(line, splits), line, splits)
+			return (None, line, splits)
+
+		# Asks the user how to split the line. Returns the (artist, track) split, 'DELETE' or 'STOP'
+		def ask_split(line, splits):
+			while len(splits) != 1:
+				if len(splits) == 0:
+					resp = input(f'"{line}" cannot be split. Do you want to RETYPE or DELETE or STOP? ')
+					if resp.upper() == 'DELETE':
+						# Skip this line
+						return 'DELETE'
+					elif resp.upper() == 'RETYPE':
+						# Give the user another chance
+						resp = input('What should the track be? ')
+						split, line, splits = auto_split(' '.join(resp.split()))
+						if split is not None:
+							return split
+					elif resp.upper() == 'STOP':
+						# Stop processing and return without saving anything
+						return 'STOP'
+				else:
+					# Too many dashes found
+					resp = input(f'"{highlight_dashes(line, splits)}" contains multiple separator dashes. Which should be the split (or STOP)? {list(range(0, len(splits)))}:')
+					if resp.upper() == 'STOP':
+						# Stop processing and return without saving anything
+						return 'STOP'
+					if resp.isnumeric() and 0 <= int(resp) < len(splits):
+						# Chosen split is used and the artist remembered for the rest of the run
+						index = int(resp)
+						splits = splits[index:index+1]
+						self.artist_index.add(line[:splits[0][0]])
+			return split_on_dash(line, splits)
+
+		# Lines resolved in previous parses of the same file, keyed by the line (and album artist) hash
+		resolutions = self.__load_resolutions(fpath)
+		def line_key(line):
+			return hashlib.sha1(f'{album_artist}\n{line}'.encode()).hexdigest()
+
+		# Lines which couldn't be split, kept for the review once the whole file is parsed
+		deferred = []
+		current_deferred = 0
+
+		with self.__open(fpath, encoding='utf-8') as tracklist:
 			# Generator function to read each line of the file
 			# Split is used to remove any extra whitespace like double spaces, tabs, or newlines
+			# Lines are counted as they're read and added to the metrics in one go at the end
 			def readline(file):
-				for line in file:
-					line = ' '.join(line.split())
-					if line:
-						yield line
-
-			for line in readline(tracklist):
+				line_count = 0
+				try:
+					for line_num, line in enumerate(file):
+						line_count += 1
+						line = ' '.join(line.split())
+						if line:
+							yield (line_num, line)
+				finally:
+					metrics.inc('lines_parsed_total', line_count, format='.txt')
+
+			for line_num, line in readline(tracklist):
 				command = line.split(' ', 1)
 				if command[0] == '!COMM':
 					# Comment row, ignore
@@ -172,73 +418,120 @@ class Reader:
 				elif command[0] == '!DATE':
 					# Change the date or time
 					timer.set_ts(command[1])
-					if len(current_batch.scrobbles) > 0:
+					if len(current_batch) > 0 or current_deferred > 0:
 						scrobble_batches.append(current_batch)
-						current_batch = self.__scrobbleBatch()
+						current_batch = self.__new_batch()
+						current_deferred = 0
 				elif command[0] == '!URL':
 					# Attempt to get a tracklist from 1001Tracklists by searching it for the URL provided
 					liveset_url = command[1]
-					current_batch.add_scrobbles(self.__scrape_tracklist(liveset_url))
+					# The liveset is parsed from its own (cached) tracklist, which is small enough to always build in full
+					count_only = self.count_only
+					self.count_only = False
+					try:
+						current_batch.add_scrobbles(self.__scrape_tracklist(liveset_url))
+					finally:
+						self.count_only = count_only
 				else:
 					# Assume it's a track otherwise
-					track = {
-						'artist': '',
-						'track': '',
-						'timestamp': 0
-					}
-					# Attempt to split the line on a hyphen, en dash, or em dash
-					splits = find_dashes(line)
-					skip = False
-					while len(splits) != 1 and not skip:
-						if len(splits) == 0:
-							# No dashes found
-							# If this is in an album, default to the Album Artist and rerun the splits
-							if album_artist is not None:
-								line = f'{album_artist} - {line}'
-								splits = find_dashes(line)
-								continue
-
-							# No Album Artist set, ask the user what to do
-							resp = input(f'"{line}" cannot be split. Do you want to RETYPE or DELETE or STOP? ')
-							if resp.upper() == 'DELETE':
-								# Skip this line
-								skip = True
-							elif resp.upper() == 'RETYPE':
-								# Give the user another chance
-								resp = input('What should the track be? ')
-								line = resp
-								splits = find_dashes(line)
-							elif resp.upper() == 'STOP':
-								# Stop processing and return without saving anything
-								return {}
-						else:
-							# Too many dashes found
-							resp = input(f'"{highlight_dashes(line, splits)}" contains multiple separator dashes. Which should be the split (or STOP)? {list(range(0, len(splits)))}:')
-							if resp.upper() == 'STOP':
-								# Stop processing and return without saving anything
-								return {}
-							if resp.isnumeric() and 0 <= int(resp) < len(splits):
-								# Chosen split is used
-								index = int(resp)
-								splits = splits[index:index+1]
-					if skip:
+					# The hash is only needed when there are resolutions to look up or one has to be saved
+					key = line_key(line) if len(resolutions) > 0 else None
+					if key in resolutions:
+						# Already resolved in a previous parse of this file
+						split = resolutions[key]
+						if split is None:
+							continue
+					else:
+						split, split_line, splits = auto_split(line)
+
+					if split is None and self.deferred:
+						# Leave room for the track in the timeline and carry on, it'll be reviewed at the end
+						deferred.append({
+							'line_num': line_num,
+							'line': split_line,
+							'splits': splits,
+							'key': key if key is not None else line_key(line),
+							'batch': current_batch,
+							'index': len(current_batch),
+							'timestamp': timer.ts,
+							'increment': timer.step(),
+							'album': album,
+							'album_artist': album_artist
+						})
+						current_deferred += 1
+						timer.increment_ts()
 						continue
-					track['artist'], track['track'] = split_on_dash(line, splits)
-					track['timestamp'] = timer.ts
-					if album is not None:
-						track.update({
-										'album': album,
-										'albumArtist': album_artist	
-									})
-					scrobble = Scrobble(track['artist'], track['track'], timer.ts,
-						 				album=track.get('album'),
-										album_artist = track.get('albumArtist'))
-					current_batch.add_scrobble(scrobble)
+					elif split is None:
+						if not self.interactive:
+							raise Exception(f'"{highlight_dashes(split_line, splits)}" in {fpath} cannot be split into an artist and track.')
+						resp = ask_split(split_line, splits)
+						if resp == 'STOP':
+							return {}
+						if key is None:
+							key = line_key(line)
+						if resp == 'DELETE':
+							self.__save_resolution(fpath, resolutions, key, None)
+							continue
+						split = resp
+						self.__save_resolution(fpath, resolutions, key, split)
+
+					self.__add_track(current_batch, split[0], split[1], timer.ts, album=album, album_artist=album_artist)
 					timer.increment_ts()
 		
 		scrobble_batches.append(current_batch)
+
+		if len(deferred) > 0:
+			if not self.interactive:
+				lines = '\n'.join(f'\tLine {x["line_num"]+1}: {highlight_dashes(x["line"], x["splits"])}' for x in deferred)
+				raise Exception(f'{len(deferred)} line(s) in {fpath} cannot be split into an artist and track:\n{lines}')
+
+			print(f'{len(deferred)} line(s) in {fpath} need to be reviewed.')
+			for x in deferred:
+				print(f'Line {x["line_num"]+1}:', end=' ')
+				resp = ask_split(x['line'], x['splits'])
+				if resp == 'STOP':
+					# Anything already answered is kept in the sidecar file for next time
+					return {}
+				x['split'] = None if resp == 'DELETE' else resp
+				self.__save_resolution(fpath, resolutions, x['key'], x['split'])
+
+			# Going backwards keeps the indexes of the earlier lines valid
+			for x in reversed(deferred):
+				batch = x['batch']
+				if x['split'] is None:
+					# The deleted track's slot is removed from the timeline
+					for scrobble in batch.scrobbles[x['index']:]:
+						scrobble.timestamp -= x['increment']
+				else:
+					scrobble = self.__make_scrobble(x['split'][0], x['split'][1], x['timestamp'], album=x['album'], album_artist=x['album_artist'])
+					batch.scrobbles.insert(x['index'], scrobble)
+			scrobble_batches = [batch for batch in scrobble_batches if len(batch) > 0]
+
 		return scrobble_batches
 
+	@staticmethod
+	def __resolutions_path(fpath):
+		return fpath.with_name(f'{fpath.name}.splits.json')
+
+	# Splits chosen by the user are kept in a sidecar file next to the tracklist
+	@staticmethod
+	def __load_resolutions(fpath):
+		if not isinstance(fpath, Path):
+			return {}
+		sidecar = Reader.__resolutions_path(fpath)
+		if not sidecar.exists():
+			return {}
+		with open(sidecar, 'r', encoding='utf-8') as f:
+			return json.load(f)
+
+	@staticmethod
+	def __save_resolution(fpath, resolutions, key, split):
+		resolutions[key] = list(split) if split is not None else None
+		if not isinstance(fpath, Path):
+			return
+		with open(Reader.__resolutions_path(fpath), 'w', encoding='utf-8') as f:
+			json.dump(resolutions, f, indent='\t')
+
 	def __csv(self, fpath):
 		import csv
 		c_artist = 0
@@ -273,13 +566,23 @@ class Reader:
 			else:
 				return val_list[column]
 
-		with open(fpath, newline='', encoding='UTF-8') as csvfile:
+		with self.__open(fpath, newline='', encoding='UTF-8') as csvfile:
 			scrobble_batches = []
 			current_batch = None
 			vals = csv.reader(csvfile, delimiter=self.csv_separator, skipinitialspace=True)
 			firstline = True
 
-			for row_num, row in enumerate(vals):
+			# Rows are counted as they're read and added to the metrics in one go at the end
+			def readrows(rows):
+				row_count = 0
+				try:
+					for row in rows:
+						row_count += 1
+						yield row
+				finally:
+					metrics.inc('lines_parsed_total', row_count, format='.csv')
+
+			for row_num, row in enumerate(readrows(vals)):
 				# Checking if the first row has column names in it
 				if firstline:
 					firstline = False
@@ -329,16 +632,65 @@ class Reader:
 				
 				# Assuming a jump of >= 15 minutes is a new set of tracks
 				if (timer.ts-timer.last_ts) >= (15*60):
-					current_batch = self.__scrobbleBatch()
+					current_batch = self.__new_batch()
 					scrobble_batches.append(current_batch)
 
 				# Creating the scrobble object and adding it to the current batch.
-				scrobble = Scrobble(artist, track, timer.ts, album=album,
-									album_artist = album_artist, track_no=track_no)
-				current_batch.add_scrobble(scrobble)
+				self.__add_track(current_batch, artist, track, timer.ts, album=album,
+								 album_artist=album_artist, track_no=track_no)
+		return scrobble_batches
+
+	# Listening history exports (Spotify, Last.FM backups, etc.), see utils/json_import.py for the formats.
+	# The file is streamed, so only the scrobbles which are kept end up in memory.
+	def __json(self, fpath, lines=False):
+		scrobble_batches = []
+		current_batch = None
+		last_ts = None
+		too_old = 0
+
+		timer.init_now()
+		with self.__open(fpath, encoding='utf-8') as jsonfile:
+			# Entries are counted as they're read and added to the metrics in one go at the end
+			def readitems(items):
+				item_count = 0
+				try:
+					for item in items:
+						item_count += 1
+						yield item
+				finally:
+					metrics.inc('lines_parsed_total', item_count, format='.jsonl' if lines else '.json')
+
+			items = iter_json_lines(jsonfile) if lines else iter_json_array(jsonfile)
+			for item in readitems(items):
+				for record in to_records(item):
+					if not record.get('artist') or not record.get('track'):
+						continue
+					ts = int(record['timestamp'])
+					if ts < timer.min_age:
+						# Last.FM won't accept these
+						too_old += 1
+						continue
+
+					# Assuming a jump of >= 15 minutes is a new set of tracks
+					if last_ts is None or abs(ts-last_ts) >= (15*60):
+						current_batch = self.__new_batch()
+						scrobble_batches.append(current_batch)
+					last_ts = ts
+
+					if self.count_only:
+						current_batch.add_timestamp(ts)
+					else:
+						metrics.inc('scrobbles_built_total')
+						current_batch.add_scrobble(Scrobble.from_record(record))
+
+		if too_old > 0:
+			print(f'Skipped {too_old} entries in {fpath} from over 14 days ago, Last.FM will not accept them.')
 		return scrobble_batches
 
 	def __scrape_tracklist(self, liveset_url):
+		# Only needed for !URL, so they aren't loaded unless a liveset has to be scraped
+		import requests
+		from bs4 import BeautifulSoup
 		scrobbles = []
 
 		# First, check to see if it's been cached
@@ -435,7 +787,7 @@ class Reader:
 		for batch in scrobble_batches:
 			start = batch.start.strftime('%Y/%m/%d %H:%M:%S')
 			end   = batch.end.strftime('%Y/%m/%d %H:%M:%S')
-			count = len(batch.scrobbles)
+			count = len(batch)
 			summary = f'{start} - {end} | {count} tracks'
 			summaries.append(summary)
 			max_len = max(max_len, len(summary))
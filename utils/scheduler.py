@@ -0,0 +1,274 @@
+import json
+import threading
+from time import time
+from uuid import uuid4
+from pathlib import Path
+
+from utils.lfm_objects import Scrobble
+from utils.file_lock import FileLock
+
+# Hierarchical timing wheel with a resolution of 1 second.
+# Each level has 256 slots, with every slot in a level covering a whole turn of the level below it,
+# so 3 levels cover about 194 days. Anything further out than that goes into an overflow list.
+# Inserting is O(1), and items are only moved down a level when their slot comes up.
+class TimingWheel:
+	SLOT_BITS = 8
+	SLOTS = 1 << SLOT_BITS
+	LEVELS = 3
+
+	def __init__(self, start=None):
+		self.current = int(start if start is not None else time())
+		self.__wheels = [[[] for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+		self.__counts = [0]*self.LEVELS
+		self.__overflow = []
+
+	def __len__(self):
+		return sum(self.__counts) + len(self.__overflow)
+
+	def insert(self, ts, item):
+		self.__place(int(ts), item)
+
+	def __place(self, ts, item):
+		# Anything already due goes in the current slot and is released on the next advance
+		ts = max(ts, self.current)
+		delta = ts - self.current
+		for level in range(self.LEVELS):
+			if delta < (1 << (self.SLOT_BITS*(level+1))):
+				slot = (ts >> (self.SLOT_BITS*level)) & (self.SLOTS-1)
+				self.__wheels[level][slot].append((ts, item))
+				self.__counts[level] += 1
+				return
+		self.__overflow.append((ts, item))
+
+	def __take(self, level, slot):
+		items = self.__wheels[level][slot]
+		if level == 0:
+			# A level 0 slot can also hold items from the next turn of the wheel
+			self.__wheels[level][slot] = [x for x in items if x[0] > self.current]
+			items = [x for x in items if x[0] <= self.current]
+		else:
+			self.__wheels[level][slot] = []
+		self.__counts[level] -= len(items)
+		return items
+
+	# Moves the wheel forward to now and returns everything that's due, in time order
+	def advance(self, now=None):
+		now = int(now if now is not None else time())
+		due = self.__take(0, self.current & (self.SLOTS-1))
+		while self.current < now:
+			if len(self) == 0:
+				self.current = now
+				break
+			# Empty lower levels are skipped over a whole turn at a time
+			step = 1
+			for level in range(self.LEVELS):
+				if self.__counts[level] > 0:
+					break
+				step = 1 << (self.SLOT_BITS*(level+1))
+			boundary = (self.current | (step-1)) + 1
+			self.current = min(boundary, now)
+
+			for level in range(1, self.LEVELS):
+				# When a level below has gone all the way around, the next slot of this level comes up
+				if self.current & ((1 << (self.SLOT_BITS*level))-1) != 0:
+					break
+				slot = (self.current >> (self.SLOT_BITS*level)) & (self.SLOTS-1)
+				for ts, item in self.__take(level, slot):
+					self.__place(ts, item)
+				if level == self.LEVELS-1:
+					overflow = self.__overflow
+					self.__overflow = []
+					for ts, item in overflow:
+						self.__place(ts, item)
+			due += self.__take(0, self.current & (self.SLOTS-1))
+		due.sort(key=lambda x: x[0])
+		return [item for _, item in due]
+
+	# Earliest timestamp in the wheel, used to sleep until something is actually due
+	def next_due(self):
+		candidates = []
+		for level in range(self.LEVELS):
+			if self.__counts[level] == 0:
+				continue
+			# Items stay in the level they were inserted into until their slot comes up, so once the wheel
+			# has moved a higher level can hold something earlier than a lower one. Every level is checked.
+			# Within a level, slots are checked in the order they come up, until the rest can only be later.
+			shift = self.SLOT_BITS*level
+			earliest = None
+			for i in range(self.SLOTS):
+				slot_start = ((self.current >> shift) + i) << shift
+				if earliest is not None and slot_start > earliest:
+					break
+				slot = self.__wheels[level][((self.current >> shift) + i) & (self.SLOTS-1)]
+				if len(slot) > 0:
+					slot_min = min(ts for ts, _ in slot)
+					if earliest is None or slot_min < earliest:
+						earliest = slot_min
+			candidates.append(earliest)
+		if len(self.__overflow) > 0:
+			candidates.append(min(ts for ts, _ in self.__overflow))
+		return min(candidates) if len(candidates) > 0 else None
+
+	# Removes and returns everything in the wheel
+	def drain(self):
+		items = [x for level in self.__wheels for slot in level for x in slot] + self.__overflow
+		self.__wheels = [[[] for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+		self.__counts = [0]*self.LEVELS
+		self.__overflow = []
+		items.sort(key=lambda x: x[0])
+		return items
+
+
+# Holds scrobbles with timestamps in the future until they've actually happened.
+# Last.FM changes any scrobbles from the future to the current time, so they can't be sent early.
+# Scheduled scrobbles are kept in an append only journal so they survive a restart.
+#
+# Only one process at a time owns the schedule (e.g. the serve action, or a scrobble action when
+# no service is running.) Only the owner releases scrobbles and compacts the journal, so nothing
+# is sent twice. Any other process can still add scrobbles, which are only appended to the journal
+# (with ids of their own) and picked up by the owner.
+class ScrobbleScheduler:
+	def __init__(self, journal_file=Path('scrobble_queue')/'schedule.jsonl', wait=False):
+		self.journal_file = Path(journal_file)
+		self.journal_file.parent.mkdir(parents=True, exist_ok=True)
+		self.__lock = threading.Lock()
+		self.__wheel = TimingWheel()
+		self.__next_id = 0
+		self.__released = 0
+		self.__journal = None
+		# Read up to here by the owner, anything after it was added since
+		self.__offset = 0
+
+		# Held for as long as this process owns the schedule
+		self.__owner_lock = FileLock(self.journal_file.with_name(f'{self.journal_file.name}.lock'))
+		# Held briefly while appending to or replacing the journal, so lines aren't mixed together
+		# and nothing is appended to a journal that's just been replaced
+		self.__write_lock = FileLock(self.journal_file.with_name(f'{self.journal_file.name}.write.lock'))
+		self.owner = self.__owner_lock.acquire(blocking=False)
+		if not self.owner and wait:
+			print(f'Waiting for another process to finish with the schedule at {self.journal_file.resolve()}.')
+			self.owner = self.__owner_lock.acquire()
+		if self.owner:
+			with self.__write_lock:
+				self.__load()
+			self.__journal = open(self.journal_file, 'a', encoding='utf-8')
+
+	def __len__(self):
+		return len(self.__wheel)
+
+	def __load(self):
+		if self.journal_file.exists():
+			pending = {}
+			with open(self.journal_file, 'r', encoding='utf-8') as f:
+				for line in f:
+					if not line.endswith('\n'):
+						# Still being written by another process
+						break
+					entry = json.loads(line)
+					if entry['op'] == 'add':
+						pending[entry['id']] = entry
+					elif entry['op'] == 'release':
+						for i in entry['ids']:
+							pending.pop(i, None)
+					if isinstance(entry.get('id'), int):
+						self.__next_id = max(self.__next_id, entry['id']+1)
+			for entry in pending.values():
+				self.__wheel.insert(entry['record']['timestamp'], (entry['id'], entry['source'], entry['record']))
+		# Only the scrobbles still waiting are kept
+		self.__compact()
+
+	# Picks up scrobbles added by other processes since the journal was last read.
+	# Their ids are strings, anything else after the offset was written by the owner itself.
+	def __read_added(self):
+		try:
+			with open(self.journal_file, 'rb') as f:
+				f.seek(self.__offset)
+				for line in f:
+					if not line.endswith(b'\n'):
+						break
+					self.__offset += len(line)
+					entry = json.loads(line)
+					if entry['op'] == 'add' and isinstance(entry['id'], str):
+						self.__wheel.insert(entry['record']['timestamp'], (entry['id'], entry['source'], entry['record']))
+		except FileNotFoundError:
+			pass
+
+	def __compact(self):
+		items = self.__wheel.drain()
+		temp_file = self.journal_file.with_suffix('.tmp')
+		with open(temp_file, 'w', encoding='utf-8') as f:
+			for ts, (i, source, record) in items:
+				f.write(json.dumps({'op': 'add', 'id': i, 'source': source, 'record': record}) + '\n')
+				self.__wheel.insert(ts, (i, source, record))
+		temp_file.replace(self.journal_file)
+		self.__offset = self.journal_file.stat().st_size
+		self.__released = 0
+
+	# Splits off the scrobbles from the future, returns the ones that can be sent now
+	def split(self, scrobbles, now=None):
+		now = now if now is not None else time()
+		ready = []
+		future = []
+		for scrobble in scrobbles:
+			(future if scrobble.timestamp > now else ready).append(scrobble)
+		return (ready, future)
+
+	def add(self, scrobbles, source=''):
+		with self.__lock:
+			if not self.owner:
+				with self.__write_lock:
+					with open(self.journal_file, 'a', encoding='utf-8') as f:
+						f.write(''.join(json.dumps({'op': 'add', 'id': uuid4().hex, 'source': source, 'record': scrobble.to_record()}) + '\n'
+										for scrobble in scrobbles))
+				return
+			with self.__write_lock:
+				for scrobble in scrobbles:
+					record = scrobble.to_record()
+					entry = {'op': 'add', 'id': self.__next_id, 'source': source, 'record': record}
+					self.__journal.write(json.dumps(entry) + '\n')
+					self.__wheel.insert(record['timestamp'], (self.__next_id, source, record))
+					self.__next_id += 1
+				self.__journal.flush()
+
+	# Returns the (source, Scrobble) pairs that are now due. confirm() should be called once
+	# they've been handed off so they aren't released again after a restart.
+	# Only the owner releases anything.
+	def due(self, now=None):
+		if not self.owner:
+			return []
+		with self.__lock:
+			self.__read_added()
+			items = self.__wheel.advance(now)
+		return items
+
+	def confirm(self, items):
+		if len(items) == 0:
+			return
+		with self.__lock, self.__write_lock:
+			self.__journal.write(json.dumps({'op': 'release', 'ids': [i for i, _, _ in items]}) + '\n')
+			self.__journal.flush()
+			self.__released += len(items)
+			if self.__released > 10000 and self.__released > len(self.__wheel):
+				# Most of the journal is released scrobbles by now
+				self.__read_added()
+				self.__journal.close()
+				self.__compact()
+				self.__journal = open(self.journal_file, 'a', encoding='utf-8')
+
+	def next_due(self):
+		if not self.owner:
+			return None
+		with self.__lock:
+			self.__read_added()
+			return self.__wheel.next_due()
+
+	@staticmethod
+	def to_scrobbles(items):
+		return [(source, Scrobble.from_record(record)) for _, source, record in items]
+
+	def close(self):
+		with self.__lock:
+			if self.__journal is not None:
+				self.__journal.close()
+				self.__journal = None
+			self.__owner_lock.release()
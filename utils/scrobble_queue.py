@@ -0,0 +1,101 @@
+import sqlite3
+import threading
+from time import time
+from pathlib import Path
+
+from utils.lfm_objects import Scrobble
+
+# Persistent queue of scrobbles waiting to be sent. Backed by sqlite so anything
+# queued survives the service being restarted.
+class ScrobbleQueue:
+	__COLUMNS = ['artist', 'track', 'timestamp', 'album', 'album_artist', 'track_no', 'mbid', 'duration']
+
+	def __init__(self, db_file=Path('scrobble_queue')/'queue.db'):
+		db_file = Path(db_file)
+		db_file.parent.mkdir(parents=True, exist_ok=True)
+		self.__lock = threading.Lock()
+		self.__conn = sqlite3.connect(db_file, check_same_thread=False)
+		with self.__conn:
+			self.__conn.execute('''
+				CREATE TABLE IF NOT EXISTS pending (
+					id INTEGER PRIMARY KEY AUTOINCREMENT,
+					artist TEXT NOT NULL,
+					track TEXT NOT NULL,
+					timestamp INTEGER NOT NULL,
+					album TEXT,
+					album_artist TEXT,
+					track_no INTEGER,
+					mbid TEXT,
+					duration INTEGER,
+					source TEXT,
+					queued_at REAL NOT NULL
+				)''')
+			self.__conn.execute('''
+				CREATE TABLE IF NOT EXISTS failed (
+					id INTEGER PRIMARY KEY,
+					artist TEXT NOT NULL,
+					track TEXT NOT NULL,
+					timestamp INTEGER NOT NULL,
+					album TEXT,
+					album_artist TEXT,
+					track_no INTEGER,
+					mbid TEXT,
+					duration INTEGER,
+					source TEXT,
+					queued_at REAL NOT NULL,
+					error TEXT
+				)''')
+
+	def __len__(self):
+		with self.__lock:
+			return self.__conn.execute('SELECT COUNT(*) FROM pending').fetchone()[0]
+
+	@property
+	def failed_count(self):
+		with self.__lock:
+			return self.__conn.execute('SELECT COUNT(*) FROM failed').fetchone()[0]
+
+	@property
+	def oldest_queued_at(self):
+		with self.__lock:
+			return self.__conn.execute('SELECT MIN(queued_at) FROM pending').fetchone()[0]
+
+	def put(self, scrobbles, source=''):
+		queued_at = time()
+		rows = []
+		for scrobble in scrobbles:
+			record = scrobble.to_record()
+			rows.append([record[col] for col in self.__COLUMNS] + [source, queued_at])
+		cols = ','.join(self.__COLUMNS + ['source', 'queued_at'])
+		marks = ','.join('?'*(len(self.__COLUMNS)+2))
+		with self.__lock, self.__conn:
+			self.__conn.executemany(f'INSERT INTO pending ({cols}) VALUES ({marks})', rows)
+		return len(rows)
+
+	# Returns up to num of the oldest pending scrobbles as (id, source, Scrobble) without removing them.
+	# They're only removed once they've actually been sent.
+	def peek(self, num=50):
+		cols = ','.join(self.__COLUMNS)
+		with self.__lock:
+			rows = self.__conn.execute(f'SELECT id, source, {cols} FROM pending ORDER BY id LIMIT ?', (num,)).fetchall()
+		items = []
+		for row in rows:
+			record = dict(zip(self.__COLUMNS, row[2:]))
+			items.append((row[0], row[1], Scrobble.from_record(record)))
+		return items
+
+	def remove(self, ids):
+		with self.__lock, self.__conn:
+			self.__conn.executemany('DELETE FROM pending WHERE id = ?', [(i,) for i in ids])
+
+	# Moves scrobbles that can't be sent out of the way so they don't block the queue
+	def fail(self, ids, error=''):
+		cols = ','.join(['id'] + self.__COLUMNS + ['source', 'queued_at'])
+		with self.__lock, self.__conn:
+			for i in ids:
+				self.__conn.execute(f'INSERT OR REPLACE INTO failed ({cols}, error) SELECT {cols}, ? FROM pending WHERE id = ?', (str(error), i))
+				self.__conn.execute('DELETE FROM pending WHERE id = ?', (i,))
+
+	def close(self):
+		with self.__lock:
+			self.__conn.close()
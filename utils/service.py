@@ -0,0 +1,216 @@
+import json
+import threading
+from time import time
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.lfm_objects import Scrobble
+from utils.reader import Reader
+from utils.scrobble_queue import ScrobbleQueue
+from utils.scheduler import ScrobbleScheduler
+from utils.exceptions import APIResponseError
+from utils.lfm_api import LFM_STATUS_RETRY, LFM_STATUS_RATE_LIMIT_EXCEEDED
+
+# Statuses where Last.FM is busy or limiting requests. The batch is fine, so it stays queued and is tried again later.
+SERVICE_STATUS_RETRY = LFM_STATUS_RETRY + [LFM_STATUS_RATE_LIMIT_EXCEEDED]
+
+# Long running service which accepts scrobbles over a local HTTP endpoint, queues them
+# persistently and sends them in full batches using a single LastFM session.
+#
+# Endpoints:
+#	POST /scrobbles?source=NAME		JSON scrobble record or list of records
+#	POST /tracklist?format=txt&source=NAME	Tracklist file contents in the body
+#	GET  /status					Number of pending, scheduled and failed scrobbles
+#
+# Scrobbles with timestamps in the future are held by the scheduler and only queued once they've happened.
+class ScrobbleService:
+	# Max seconds between checks for scrobbles scheduled by other processes
+	SCHEDULE_POLL = 30
+
+	def __init__(self, lfm, increment, csv_separator, queue=None, batch_size=50, linger=60, scheduler=None):
+		self.lfm = lfm
+		self.increment = increment
+		self.csv_separator = csv_separator
+		self.queue = queue if queue is not None else ScrobbleQueue()
+		self.scheduler = scheduler if scheduler is not None else ScrobbleScheduler(wait=True)
+		self.batch_size = min(batch_size, 50)
+		# Max time (in seconds) a partial batch waits for more scrobbles before it's sent anyway
+		self.linger = linger
+
+		# The reader's timer is shared state, so only one tracklist can be parsed at a time
+		self.__parse_lock = threading.Lock()
+		self.__wakeup = threading.Event()
+		self.__rescheduled = threading.Event()
+		self.__stop = threading.Event()
+		self.__sender = None
+		self.__releaser = None
+		self.__server = None
+
+	def submit_scrobbles(self, records, source=''):
+		if isinstance(records, dict):
+			records = [records]
+		scrobbles = [Scrobble.from_record(record) for record in records]
+		return self.__put(scrobbles, source)
+
+	def submit_tracklist(self, text, ext='txt', source=''):
+		with self.__parse_lock:
+			# Nobody is around to answer prompts in the service
+			r = Reader(self.increment, self.csv_separator, interactive=False)
+			scrobbles = Reader.serialize_scrobbles(r.read_string(text, ext))
+		return self.__put(scrobbles, source)
+
+	def __put(self, scrobbles, source):
+		ready, future = self.scheduler.split(scrobbles)
+		if len(future) > 0:
+			self.scheduler.add(future, source)
+			self.__rescheduled.set()
+		count = self.queue.put(ready, source) if len(ready) > 0 else 0
+		self.__wakeup.set()
+		return count + len(future)
+
+	# Seconds until the next batch should be sent, 0 if there's one ready or None if the queue is empty
+	def __time_until_ready(self):
+		pending = len(self.queue)
+		if pending >= self.batch_size:
+			return 0
+		oldest = self.queue.oldest_queued_at
+		if pending == 0 or oldest is None:
+			return None
+		return max(0, self.linger - (time() - oldest))
+
+	# Moves scheduled scrobbles into the queue as their timestamps pass. Sleeps until
+	# the next one is due, or until something earlier is scheduled.
+	def __release_loop(self):
+		while not self.__stop.is_set():
+			items = self.scheduler.due()
+			if len(items) > 0:
+				sources = {}
+				for source, scrobble in ScrobbleScheduler.to_scrobbles(items):
+					sources.setdefault(source, []).append(scrobble)
+				for source, scrobbles in sources.items():
+					self.queue.put(scrobbles, source)
+				self.scheduler.confirm(items)
+				self.__wakeup.set()
+
+			# Scrobble actions can add to the schedule while the service is running, so it's checked every so often
+			next_due = self.scheduler.next_due()
+			wait = self.SCHEDULE_POLL if next_due is None else min(max(0, next_due - time()), self.SCHEDULE_POLL)
+			self.__rescheduled.wait(wait)
+			self.__rescheduled.clear()
+
+	def __send_loop(self):
+		with self.lfm.open_log('serve') as log_file:
+			# Seconds to wait before retrying, doubled each time a batch can't be sent
+			backoff = 0
+			while not self.__stop.is_set():
+				wait = self.__time_until_ready()
+				if wait != 0:
+					# Woken up early by new submissions, otherwise when the oldest partial batch has lingered long enough
+					self.__wakeup.wait(wait)
+					self.__wakeup.clear()
+					continue
+
+				items = self.queue.peek(self.batch_size)
+				ids = [i for i, _, _ in items]
+				batch = [scrobble for _, _, scrobble in items]
+				try:
+					resp = self.lfm.send_batch(batch)
+				except APIResponseError as e:
+					if e.error_no not in SERVICE_STATUS_RETRY:
+						# Last.FM rejected the batch, retrying it won't help
+						log_file.write(f'Batch of {len(batch)} failed: {e}\n')
+						self.queue.fail(ids, e)
+						continue
+					backoff = min(backoff*2, 15*60) if backoff > 0 else 30
+					log_file.write(f'Unable to send batch of {len(batch)}: {e}, trying again in {backoff}s\n')
+					log_file.flush()
+					self.__stop.wait(backoff)
+					continue
+				except Exception as e:
+					# Most likely a network issue, leave the batch queued and try again later
+					backoff = min(backoff*2, 15*60) if backoff > 0 else 30
+					log_file.write(f'Unable to send batch of {len(batch)}: {e}, trying again in {backoff}s\n')
+					log_file.flush()
+					self.__stop.wait(backoff)
+					continue
+				backoff = 0
+
+				sources = {}
+				for _, source, _ in items:
+					source = source or 'unknown'
+					sources[source] = sources.get(source, 0) + 1
+				source_counts = ', '.join(f'{k}: {v}' for k, v in sources.items())
+				log_file.write(f'Batch of {len(batch)} sent ({source_counts})\n')
+				accepted, ignored = self.lfm.log_results(log_file, resp)
+				log_file.write(f'Accepted: {accepted}\n')
+				log_file.write(f'Ignored: {ignored}\n')
+				log_file.flush()
+				self.queue.remove(ids)
+
+	def start(self, port, host='127.0.0.1'):
+		service = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def __respond(self, status, body):
+				body = json.dumps(body).encode()
+				self.send_response(status)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def do_GET(self):
+				url = urlparse(self.path)
+				if url.path == '/status':
+					self.__respond(200, {'pending': len(service.queue), 'scheduled': len(service.scheduler),
+										 'failed': service.queue.failed_count})
+				else:
+					self.__respond(404, {'error': f'Unknown endpoint {url.path}'})
+
+			def do_POST(self):
+				url = urlparse(self.path)
+				query = parse_qs(url.query)
+				source = query.get('source', [''])[0]
+				length = int(self.headers.get('Content-Length', 0))
+				body = self.rfile.read(length).decode('utf-8')
+				try:
+					if url.path == '/scrobbles':
+						count = service.submit_scrobbles(json.loads(body), source)
+					elif url.path == '/tracklist':
+						count = service.submit_tracklist(body, query.get('format', ['txt'])[0], source)
+					else:
+						self.__respond(404, {'error': f'Unknown endpoint {url.path}'})
+						return
+				except Exception as e:
+					self.__respond(400, {'error': str(e)})
+					return
+				self.__respond(200, {'queued': count})
+
+			def log_message(self, format, *args):
+				pass
+
+		self.__sender = threading.Thread(target=self.__send_loop, daemon=True)
+		self.__sender.start()
+		self.__releaser = threading.Thread(target=self.__release_loop, daemon=True)
+		self.__releaser.start()
+		self.__server = ThreadingHTTPServer((host, int(port)), Handler)
+		print(f'Scrobble service for user {self.lfm.user} listening on http://{host}:{port}')
+		try:
+			self.__server.serve_forever()
+		finally:
+			self.stop()
+
+	def stop(self):
+		self.__stop.set()
+		self.__wakeup.set()
+		self.__rescheduled.set()
+		if self.__sender is not None:
+			self.__sender.join()
+			self.__sender = None
+		if self.__releaser is not None:
+			self.__releaser.join()
+			self.__releaser = None
+			self.scheduler.close()
+		if self.__server is not None:
+			self.__server.server_close()
+			self.__server = None
@@ -0,0 +1,274 @@
+import os
+import json
+import socket
+import threading
+from time import time
+from uuid import uuid4
+from pathlib import Path
+
+# A lease on a file or profile, held by creating a lease file that expires unless it's renewed.
+# Creating the file is atomic (O_EXCL), so only one worker can hold it at a time, even across
+# hosts sharing the directory. An expired lease is taken over by renaming it out of the way first,
+# which only one worker can win. Every lease file has its own token, so a worker can tell whether
+# the file it moved aside or is renewing is still the one it read.
+class Lease:
+	def __init__(self, path, worker, ttl=120):
+		self.path = Path(path)
+		self.worker = worker
+		self.ttl = ttl
+		self.token = None
+
+	@staticmethod
+	def __read_file(path):
+		try:
+			with open(path, 'r', encoding='utf-8') as f:
+				return json.load(f)
+		except (FileNotFoundError, json.JSONDecodeError):
+			return None
+
+	def __read(self):
+		return self.__read_file(self.path)
+
+	def __contents(self):
+		return {'worker': self.worker, 'token': self.token, 'expires': time() + self.ttl}
+
+	def __create(self):
+		try:
+			fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+		except FileExistsError:
+			return False
+		self.token = uuid4().hex
+		with os.fdopen(fd, 'w', encoding='utf-8') as f:
+			json.dump(self.__contents(), f)
+		return True
+
+	@property
+	def owner(self):
+		lease = self.__read()
+		if lease is None or lease['expires'] < time():
+			return None
+		return lease['worker']
+
+	@property
+	def held(self):
+		lease = self.__read()
+		return lease is not None and self.token is not None and lease.get('token') == self.token and lease['expires'] >= time()
+
+	def __is_stale(self, lease, path):
+		if lease is not None:
+			return lease['expires'] < time()
+		# Can't be read, either it's being written right now or whoever was writing it died
+		try:
+			return os.stat(path).st_mtime + self.ttl < time()
+		except FileNotFoundError:
+			return False
+
+	def acquire(self):
+		if self.__create():
+			return True
+		lease = self.__read()
+		if not self.__is_stale(lease, self.path):
+			return False
+		# Stale (or half written) lease, move it aside and try again
+		stale = self.path.with_name(f'{self.path.name}.stale-{uuid4().hex}')
+		try:
+			os.rename(self.path, stale)
+		except FileNotFoundError:
+			# Someone else got to it first
+			return False
+		# Between reading the lease and moving it, another worker may have taken it over and made a new one.
+		# If that's what was moved, it's put back (unless yet another worker has made one since) and left alone.
+		moved = self.__read_file(stale)
+		if moved != lease or not self.__is_stale(moved, stale):
+			try:
+				os.link(stale, self.path)
+			except FileExistsError:
+				pass
+			stale.unlink()
+			return False
+		stale.unlink()
+		return self.__create()
+
+	# Renewing only happens while the lease is still this worker's and well before it expires,
+	# so it can't have been taken over in the meantime. Once it's lost it's never renewed again.
+	def renew(self):
+		if self.token is None:
+			return False
+		lease = self.__read()
+		if lease is None or lease.get('token') != self.token or lease['expires'] - time() < self.ttl/3:
+			self.token = None
+			return False
+		temp = self.path.with_name(f'{self.path.name}.{uuid4().hex}')
+		with open(temp, 'w', encoding='utf-8') as f:
+			json.dump(self.__contents(), f)
+		os.replace(temp, self.path)
+		return True
+
+	def release(self):
+		if self.held:
+			self.path.unlink(missing_ok=True)
+		self.token = None
+
+
+# Shared spool directory for spreading tracklists over workers on several hosts:
+#	incoming/PROFILE/	Tracklists waiting to be sent to PROFILE
+#	claimed/PROFILE/	Tracklists being sent, each with a FILE.lease
+#	done/PROFILE/		Tracklists that were sent
+#	failed/PROFILE/		Tracklists that couldn't be sent, with the error in FILE.error
+#	profiles/PROFILE.lease	Held by the worker sending for PROFILE
+#
+# A worker only claims a file once it holds the profile's lease, so no two workers send for the same
+# session at once. Leases are renewed by a heartbeat, and files whose lease expired (e.g. the worker died)
+# are put back into incoming for another worker to pick up.
+class Spool:
+	# Files kept next to a tracklist (e.g. the reader's saved splits), moved along with it
+	SIDECARS = ['.splits.json']
+
+	def __init__(self, root, ttl=120, worker=None, extensions=None):
+		self.root = Path(root)
+		self.ttl = ttl
+		# Only files with these suffixes are picked up, so things like sidecar files are left alone
+		self.extensions = extensions
+		self.worker = worker if worker is not None else f'{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:6]}'
+		for folder in ['incoming', 'claimed', 'done', 'failed', 'profiles']:
+			(self.root/folder).mkdir(parents=True, exist_ok=True)
+
+		self.__leases = []
+		self.__leases_lock = threading.Lock()
+		self.__stop = threading.Event()
+		self.__heartbeat = None
+
+	def __enter__(self):
+		self.__heartbeat = threading.Thread(target=self.__heartbeat_loop, daemon=True)
+		self.__heartbeat.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.__stop.set()
+		self.__heartbeat.join()
+		with self.__leases_lock:
+			leases = self.__leases
+			self.__leases = []
+		for lease in leases:
+			lease.release()
+
+	def __heartbeat_loop(self):
+		while not self.__stop.wait(self.ttl/3):
+			with self.__leases_lock:
+				leases = list(self.__leases)
+			for lease in leases:
+				if not lease.renew():
+					print(f'Lost the lease on {lease.path}.')
+					with self.__leases_lock:
+						if lease in self.__leases:
+							self.__leases.remove(lease)
+
+	def __hold(self, lease):
+		with self.__leases_lock:
+			self.__leases.append(lease)
+
+	def __drop(self, lease):
+		with self.__leases_lock:
+			if lease in self.__leases:
+				self.__leases.remove(lease)
+		lease.release()
+
+	def __is_tracklist(self, fpath):
+		if not fpath.is_file() or '.lease' in fpath.name or any(fpath.name.endswith(x) for x in self.SIDECARS):
+			return False
+		return self.extensions is None or fpath.suffix.lower() in self.extensions
+
+	# Moves the tracklist, then any of its sidecars
+	def __move(self, fpath, target):
+		os.rename(fpath, target)
+		for suffix in self.SIDECARS:
+			try:
+				os.rename(fpath.with_name(f'{fpath.name}{suffix}'), target.with_name(f'{target.name}{suffix}'))
+			except FileNotFoundError:
+				pass
+
+	def profiles(self):
+		return sorted(x.name for x in (self.root/'incoming').iterdir() if x.is_dir())
+
+	def pending(self, profile):
+		folder = self.root/'incoming'/profile
+		if not folder.exists():
+			return []
+		return sorted(x for x in folder.iterdir() if self.__is_tracklist(x))
+
+	def acquire_profile(self, profile):
+		lease = Lease(self.root/'profiles'/f'{profile}.lease', self.worker, self.ttl)
+		if not lease.acquire():
+			return None
+		self.__hold(lease)
+		return lease
+
+	def release_profile(self, lease):
+		self.__drop(lease)
+
+	# Puts files whose worker stopped renewing their lease back into incoming
+	def reclaim(self):
+		reclaimed = 0
+		claimed = self.root/'claimed'
+		for folder in [x for x in claimed.iterdir() if x.is_dir()]:
+			for fpath in [x for x in folder.iterdir() if self.__is_tracklist(x)]:
+				lease = Lease(fpath.with_name(f'{fpath.name}.lease'), self.worker, self.ttl)
+				if not lease.acquire():
+					continue
+				incoming = self.root/'incoming'/folder.name
+				incoming.mkdir(exist_ok=True)
+				try:
+					self.__move(fpath, incoming/fpath.name)
+					reclaimed += 1
+				except FileNotFoundError:
+					pass
+				lease.release()
+		return reclaimed
+
+	# Claims the tracklist for this worker. Returns the claimed path and its lease, or None if someone else got it.
+	def claim(self, fpath):
+		profile = fpath.parent.name
+		claimed = self.root/'claimed'/profile
+		claimed.mkdir(exist_ok=True)
+		target = claimed/fpath.name
+		# The lease comes first, so a claimed file never exists without one
+		lease = Lease(target.with_name(f'{target.name}.lease'), self.worker, self.ttl)
+		if not lease.acquire():
+			return None
+		try:
+			self.__move(fpath, target)
+		except FileNotFoundError:
+			lease.release()
+			return None
+		self.__hold(lease)
+		return (target, lease)
+
+	# Returns where the file was moved to, or None if the claim was lost (e.g. the lease expired while
+	# sending and another worker put the file back into incoming)
+	def __finish(self, fpath, lease, folder):
+		if not lease.held:
+			self.__drop(lease)
+			return None
+		out = self.root/folder/fpath.parent.name
+		out.mkdir(exist_ok=True)
+		target = out/fpath.name
+		if target.exists():
+			# Same file name sent before, keep both
+			target = out/f'{fpath.stem}_{int(time())}{fpath.suffix}'
+		try:
+			self.__move(fpath, target)
+		except FileNotFoundError:
+			target = None
+		self.__drop(lease)
+		return target
+
+	def complete(self, fpath, lease):
+		return self.__finish(fpath, lease, 'done')
+
+	def fail(self, fpath, lease, error):
+		target = self.__finish(fpath, lease, 'failed')
+		if target is None:
+			return None
+		with open(target.with_name(f'{target.name}.error'), 'w', encoding='utf-8') as f:
+			f.write(f'{error}\n')
+		return target